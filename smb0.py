@@ -2,6 +2,27 @@ import pygame
 import sys
 import math
 import random
+import argparse
+import weakref
+import threading
+import time
+import queue
+import asyncio
+import os
+import socket
+import struct
+import shlex
+import subprocess
+import hashlib
+import json
+import zlib
+import re
+import bisect
+import operator
+import gc
+import tracemalloc
+from array import array
+from collections import deque, namedtuple
 
 # --- Initialization ---
 pygame.init()
@@ -31,6 +52,11 @@ BLACK = (0, 0, 0)
 PARTICLE_COLORS = [(255, 255, 100), (255, 200, 50), (255, 150, 0)]
 
 # --- SM64DS-Inspired Physics ---
+# Physics is specified in ticks of 1/REFERENCE_HZ seconds, whatever rate the
+# simulation actually steps at: speeds are px/tick, accelerations px/tick^2,
+# friction is the fraction of speed kept per tick and durations are ticks.
+# Each step advances SIM_TICKS ticks (see configure_simulation).
+REFERENCE_HZ = 60
 GRAVITY = 0.6
 PLAYER_WALK_ACC = 0.5
 PLAYER_RUN_ACC = 0.9
@@ -38,20 +64,818 @@ PLAYER_FRICTION = 0.88  # Momentum-based
 PLAYER_AIR_FRICTION = 0.95
 PLAYER_JUMP_STRENGTH = -15
 PLAYER_JUMP_BOOST = -2.5  # Hold jump for higher jump
+PLAYER_JUMP_BOOST_TICKS = 10
 MAX_WALK_SPEED = 4
 MAX_RUN_SPEED = 7
 ENEMY_SPEED = 1
+PARTICLE_GRAVITY = 0.3
+PARTICLE_LIFE_TICKS = 30
+BLOCK_BOUNCE_TICKS = 20
+SQUISH_TICKS = 30
+
+# Simulation rate; the defaults step exactly one tick per frame
+SIM_HZ = FPS
+SIM_TICKS = REFERENCE_HZ / SIM_HZ
+
+def configure_simulation(hz):
+    """Step the simulation ``hz`` times per second.
+
+    Motion between collisions follows the same path at any rate. Collisions
+    are resolved once per step, Y before X, so a jump that grazes a block's
+    corner can hit it at one rate and slip past it at another; runs at
+    different rates agree only until the first such contact.
+    """
+    global SIM_HZ, SIM_TICKS
+    SIM_HZ = hz
+    SIM_TICKS = REFERENCE_HZ / hz
+
+def crossed(timer, step, period):
+    """True if advancing a tick counter by ``step`` to ``timer`` passed a multiple of ``period``."""
+    return timer // period != (timer - step) // period
+
+# --- Metrics ---
+# Cheap enough to leave on: a timing is one bucket increment, a counter one
+# dict update. MetricsWriter publishes them from its own thread.
+METRICS_INTERVAL = 10.0
+METRICS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+class Histogram:
+    """Log-linear histogram of durations in whole microseconds (HDR style).
+
+    Values below 64 us are counted exactly; above that every power of two
+    is split into 32 buckets, so a recorded value is off by at most ~3%.
+    Anything over ~67 s lands in the last bucket.
+    """
+    SUB_BITS = 5
+    BUCKETS = 22 << 5
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total = 0.0
+        self.largest = 0.0
+
+    @classmethod
+    def bucket(cls, us):
+        shift = us.bit_length() - 1 - cls.SUB_BITS
+        if shift <= 0:
+            return us
+        return min((shift << cls.SUB_BITS) + (us >> shift), cls.BUCKETS - 1)
+
+    @classmethod
+    def upper_bound(cls, index):
+        """Largest value, in seconds, that falls in bucket ``index``."""
+        shift = max(0, (index >> cls.SUB_BITS) - 1)
+        mantissa = index - (shift << cls.SUB_BITS)
+        return (((mantissa + 1) << shift) - 1) / 1e6
+
+    def record(self, seconds):
+        self.counts[self.bucket(int(seconds * 1e6))] += 1
+        self.total += seconds
+        if seconds > self.largest:
+            self.largest = seconds
+
+    @classmethod
+    def quantiles(cls, counts, qs=METRICS_QUANTILES):
+        """Upper bound of the bucket holding each quantile of ``counts``; None if empty."""
+        n = sum(counts)
+        if not n:
+            return [None] * len(qs)
+        result = []
+        seen = 0
+        index = -1
+        for q in qs:
+            rank = max(1, math.ceil(q * n))
+            while seen < rank:
+                index += 1
+                seen += counts[index]
+            result.append(cls.upper_bound(index))
+        return result
+
+class Metrics:
+    """Frame timings and event counters for the whole process."""
+
+    TIMERS = ('frame', 'simulation', 'render', 'present', 'jitter', 'input_latency')
+    COUNTERS = ('deaths', 'blocks_hit', 'level_loads', 'missed_deadlines', 'particles_spawned', 'particles_dropped',
+                'scaled_cache_hits', 'scaled_cache_misses',
+                'text_cache_hits', 'text_cache_misses',
+                'stamp_cache_hits', 'stamp_cache_misses',
+                'prefetch_hits', 'prefetch_misses', 'mismatched_blits')
+
+    def __init__(self):
+        self.timers = {name: Histogram() for name in self.TIMERS}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.frame_start = None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def time(self, name, seconds):
+        self.timers[name].record(seconds)
+
+    def frame(self, now):
+        """Record the time since the previous frame; call once per frame."""
+        if self.frame_start is not None:
+            self.timers['frame'].record(now - self.frame_start)
+        self.frame_start = now
+
+    def frame_gap(self):
+        """Don't count the time until the next frame (idle, paused, ...)."""
+        self.frame_start = None
+
+    def sample(self):
+        """Copy of the current values, safe to format while the game runs."""
+        timers = {name: (list(h.counts), h.total, h.largest) for name, h in self.timers.items()}
+        return timers, dict(self.counters)
+
+metrics = Metrics()
+
+def prometheus_text(timers, counters, previous):
+    """Prometheus exposition text; quantiles cover the time since ``previous``."""
+    lines = []
+    for name, (counts, total, largest) in timers.items():
+        metric = f"smb_{name}_seconds"
+        window = [now - before for now, before in zip(counts, previous.get(name, ()))] or counts
+        lines.append(f"# TYPE {metric} summary")
+        for q, value in zip(METRICS_QUANTILES, Histogram.quantiles(window)):
+            lines.append(f'{metric}{{quantile="{q}"}} {"NaN" if value is None else value}')
+        lines.append(f"{metric}_sum {total}")
+        lines.append(f"{metric}_count {sum(counts)}")
+        lines.append(f"# TYPE smb_{name}_max_seconds gauge")
+        lines.append(f"smb_{name}_max_seconds {largest}")
+    for name, value in counters.items():
+        lines.append(f"# TYPE smb_{name}_total counter")
+        lines.append(f"smb_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+def metrics_record(timers, counters, previous):
+    """One JSON-lines record; quantiles cover the time since ``previous``."""
+    record = {'time': time.time()}
+    for name, (counts, total, largest) in timers.items():
+        window = [now - before for now, before in zip(counts, previous.get(name, ()))] or counts
+        stats = {'count': sum(counts), 'sum': total, 'max': largest}
+        for q, value in zip(METRICS_QUANTILES, Histogram.quantiles(window)):
+            stats[f"p{q * 100:g}"] = value
+        record[name] = stats
+    record.update(counters)
+    return json.dumps(record) + "\n"
+
+class MetricsWriter:
+    """Periodically publishes ``metrics`` to PATH from a background thread.
+
+    ``*.jsonl`` paths get one appended record per interval. Anything else is
+    a Prometheus textfile, rewritten through a temporary file and
+    ``os.replace`` so a scraper never sees half of it.
+    """
+
+    def __init__(self, path, interval=METRICS_INTERVAL, source=metrics):
+        self.path = path
+        self.interval = interval
+        self.source = source
+        self.jsonl = path.endswith('.jsonl')
+        self.previous = {}
+        self.error = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        timers, counters = self.source.sample()
+        try:
+            if self.jsonl:
+                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try:
+                    os.write(fd, metrics_record(timers, counters, self.previous).encode())
+                finally:
+                    os.close(fd)
+            else:
+                temporary = f"{self.path}.{os.getpid()}.tmp"
+                with open(temporary, 'w') as f:
+                    f.write(prometheus_text(timers, counters, self.previous))
+                os.replace(temporary, self.path)
+        except OSError as error:
+            self.error = error
+        self.previous = {name: counts for name, (counts, _, _) in timers.items()}
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+# --- Render Scaling ---
+# The game is authored in SCREEN_WIDTH x SCREEN_HEIGHT logical pixels. Anything
+# drawn through these helpers lands correctly on a smaller (or larger) target:
+# sprites are resized once and cached until their owner redraws them.
+UNSCALED = (1.0, 1.0)
+_scaled_surfaces = weakref.WeakKeyDictionary()
+
+def surface_scale(surface):
+    """Scale from logical game pixels to pixels of ``surface``."""
+    return (surface.get_width() / SCREEN_WIDTH, surface.get_height() / SCREEN_HEIGHT)
+
+def scaled_surface(surf, scale):
+    by_scale = _scaled_surfaces.get(surf)
+    if by_scale is None:
+        by_scale = _scaled_surfaces[surf] = {}
+    result = by_scale.get(scale)
+    if result is None:
+        metrics.count('scaled_cache_misses')
+        size = (max(1, round(surf.get_width() * scale[0])),
+                max(1, round(surf.get_height() * scale[1])))
+        result = by_scale[scale] = pygame.transform.scale(surf, size)
+    else:
+        metrics.count('scaled_cache_hits')
+    return result
+
+def invalidate_scaled(surf):
+    """Drop cached resized copies of ``surf`` after drawing into it."""
+    _scaled_surfaces.pop(surf, None)
+
+def blit_logical(target, surf, pos, scale=None):
+    """Blit ``surf`` at logical position ``pos``, resized to suit ``target``."""
+    if scale is None:
+        scale = surface_scale(target)
+    if scale != UNSCALED:
+        surf, pos = scaled_surface(surf, scale), (int(pos[0] * scale[0]), int(pos[1] * scale[1]))
+    if blit_audit is not None:
+        blit_audit.check(target, (surf,), depth=2)
+    return target.blit(surf, pos)
+
+def integer_scale_rect(size, bounds):
+    """Largest whole multiple of ``size`` that fits ``bounds``, centered in it.
+
+    Falls back to an aspect-preserving fit when ``size`` is larger than
+    ``bounds``.
+    """
+    factor = min(bounds[0] // size[0], bounds[1] // size[1])
+    if factor >= 1:
+        w, h = size[0] * factor, size[1] * factor
+    else:
+        fit = min(bounds[0] / size[0], bounds[1] / size[1])
+        w, h = int(size[0] * fit), int(size[1] * fit)
+    rect = pygame.Rect(0, 0, w, h)
+    rect.center = (bounds[0] // 2, bounds[1] // 2)
+    return rect
+
+# --- Presentation ---
+class Display:
+    """The window, the surface the game renders into, and how one reaches the other.
+
+    Backends:
+      'window'    software window; the render target is the window surface when
+                  sizes match, otherwise it is integer-scaled into the window
+      'scaled'    window surface has the render size and SDL scales it on the
+                  GPU (pygame.SCALED)
+      'renderer'  pygame._sdl2 Renderer; each frame is uploaded to a streaming
+                  texture and drawn integer-scaled. Falls back to 'window' when
+                  no renderer can be created.
+
+    With ``vsync``, 'scaled' and 'renderer' present in step with the
+    display's refresh (``self.vsync`` says whether it was requested);
+    'window' cannot.
+    """
+
+    def __init__(self, render_size=(SCREEN_WIDTH, SCREEN_HEIGHT), window_size=None,
+                 fullscreen=False, backend='window', vsync=False):
+        self.render_size = tuple(render_size)
+        if window_size is None:
+            window_size = pygame.display.get_desktop_sizes()[0] if fullscreen else self.render_size
+        self.window_size = tuple(window_size)
+        self.fullscreen = fullscreen
+        self.window = None
+        self.renderer = None
+        self.texture = None
+        self.vsync = False  # Whether presenting was asked to wait for vblank
+        if backend in ('scaled', 'renderer') and pygame.display.get_surface() is not None:
+            # SDL cannot put a renderer on a window that already has a surface
+            pygame.display.quit()
+            pygame.display.init()
+        if backend == 'renderer':
+            try:
+                self._open_renderer(vsync)
+            except pygame.error:
+                backend = 'window'
+        if backend == 'scaled':
+            flags = pygame.SCALED | (pygame.FULLSCREEN if fullscreen else 0)
+            self.window_surface = self.surface = pygame.display.set_mode(self.render_size, flags,
+                                                                         vsync=int(vsync))
+            self.vsync = vsync
+        elif backend == 'window':
+            flags = pygame.DOUBLEBUF | (pygame.FULLSCREEN if fullscreen else 0)
+            self.window_surface = pygame.display.set_mode(self.window_size, flags)
+            if self.window_size == self.render_size:
+                self.surface = self.window_surface
+            else:
+                self.surface = pygame.Surface(self.render_size, 0, self.window_surface)
+                self.window_surface.fill(BLACK)
+                self.dest = self.window_surface.subsurface(
+                    integer_scale_rect(self.render_size, self.window_size))
+        self.backend = backend
+        pygame.display.set_caption(GAME_TITLE)
+
+    def _open_renderer(self, vsync=False):
+        from pygame._sdl2.video import Window, Renderer, Texture
+
+        self.window = Window(GAME_TITLE, size=self.window_size,
+                             fullscreen_desktop=self.fullscreen)
+        self.renderer = Renderer(self.window, vsync=vsync)
+        self.vsync = vsync
+        self.renderer.draw_color = (*BLACK, 255)
+        self.texture = Texture(self.renderer, self.render_size, streaming=True)
+        self.dest = integer_scale_rect(self.render_size, self.window.size)
+        self.surface = pygame.Surface(self.render_size)
+
+    def present(self):
+        if self.backend == 'renderer':
+            self.texture.update(self.surface)
+            self.renderer.clear()
+            self.texture.draw(dstrect=self.dest)
+            self.renderer.present()
+            return
+        if self.surface is not self.window_surface:
+            pygame.transform.scale(self.surface, self.dest.get_size(), self.dest)
+        pygame.display.flip()
+
+# --- Frame Capture ---
+CAPTURE_QUEUE_FRAMES = 8     # Frames buffered for the writer before capture starts dropping
+CAPTURE_CHUNK_FRAMES = 1800  # Frames per raw chunk file (30 s at 60 FPS)
+
+def ffmpeg_pixel_format(surface):
+    """ffmpeg ``-pix_fmt`` name for the surface's raw pixel layout (little-endian)."""
+    layouts = {
+        (32, (0xff0000, 0xff00, 0xff)): 'bgr0',
+        (32, (0xff, 0xff00, 0xff0000)): 'rgb0',
+        (24, (0xff0000, 0xff00, 0xff)): 'bgr24',
+        (24, (0xff, 0xff00, 0xff0000)): 'rgb24',
+    }
+    key = (surface.get_bitsize(), surface.get_masks()[:3])
+    if key not in layouts:
+        raise ValueError(f"no raw video format for {key[0]}-bit masks {key[1]}")
+    fmt = layouts[key]
+    if fmt.endswith('0') and surface.get_masks()[3]:
+        fmt = fmt[:3] + 'a'
+    return fmt
+
+class RawChunkSink:
+    """Writes frames into fixed-size chunk files with a text index.
+
+    ``<base>.idx`` starts with ``width height pitch pix_fmt fps`` and then has
+    one ``frame time_ms chunk offset`` line per tick of the capture clock.
+    A tick that showed the same picture as the one before points at that
+    frame's data rather than storing it again. Chunks are
+    ``<base>.NNNN.raw``.
+    """
+
+    def __init__(self, base, surface, chunk_frames=CAPTURE_CHUNK_FRAMES):
+        self.base = base
+        self.chunk_frames = chunk_frames
+        self.chunk = -1
+        self.in_chunk = chunk_frames
+        self.file = None
+        self.last = None  # (chunk, offset) of the last frame written
+        self.index = open(base + '.idx', 'w')
+        width, height = surface.get_size()
+        self.index.write(f"{width} {height} {surface.get_pitch()} {ffmpeg_pixel_format(surface)} {SIM_HZ}\n")
+
+    def write(self, frame, timestamp, data):
+        if self.in_chunk >= self.chunk_frames:
+            if self.file is not None:
+                self.file.close()
+            self.chunk += 1
+            self.in_chunk = 0
+            self.file = open(f"{self.base}.{self.chunk:04d}.raw", 'wb')
+        self.last = (self.chunk, self.file.tell())
+        self.index.write(f"{frame} {timestamp * 1000:.3f} {self.chunk} {self.last[1]}\n")
+        self.file.write(data)
+        self.in_chunk += 1
+
+    def repeat(self, frame, timestamp, data):
+        self.index.write(f"{frame} {timestamp * 1000:.3f} {self.last[0]} {self.last[1]}\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.index.close()
+
+class PipeSink:
+    """Streams raw frames into an encoder's stdin.
+
+    ``command`` is a shell-style string; ``{width}``, ``{height}``,
+    ``{pix_fmt}`` and ``{fps}`` are filled in, e.g.
+    ``ffmpeg -f rawvideo -pix_fmt {pix_fmt} -s {width}x{height} -r {fps} -i - out.mp4``.
+    ``{fps}`` is the capture clock's rate and every tick of it gets a frame,
+    so the video keeps time. The surface must have no row padding (pitch ==
+    width * bytes per pixel).
+    """
+
+    def __init__(self, command, surface):
+        width, height = surface.get_size()
+        if surface.get_pitch() != width * surface.get_bytesize():
+            raise ValueError("cannot pipe a surface with padded rows")
+        args = [arg.format(width=width, height=height, fps=SIM_HZ, pix_fmt=ffmpeg_pixel_format(surface))
+                for arg in shlex.split(command)]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def write(self, frame, timestamp, data):
+        self.process.stdin.write(data)
+
+    repeat = write
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class FrameRecorder:
+    """Captures presented frames without stalling the game loop.
+
+    Frames are taken on a clock ticking at SIM_HZ from the start of the
+    capture. ``capture`` files what was presented under the current tick;
+    ticks in which nothing was presented (the picture didn't change, the
+    game was paused or idle, or the frame was dropped) repeat the frame
+    before them, so every tick has a frame and the output keeps real time.
+
+    A fixed pool of frame buffers is allocated up front. ``capture`` copies
+    the surface's pixels straight from its buffer view into a free one (a
+    single memcpy, no per-frame Python objects) and queues it; a writer
+    thread hands queued buffers to the sink, keeping the latest back to
+    repeat, and returns the rest to the pool. If the writer falls behind and
+    the pool is empty the frame is dropped and counted rather than waited
+    for.
+    """
+
+    def __init__(self, sink, surface, queue_frames=CAPTURE_QUEUE_FRAMES):
+        self.sink = sink
+        self.hz = SIM_HZ
+        self.frame_bytes = surface.get_pitch() * surface.get_height()
+        self.free = queue.Queue()
+        # One more than the queue holds, for the frame the writer keeps to repeat
+        for _ in range(queue_frames + 1):
+            self.free.put(bytearray(self.frame_bytes))
+        self.pending = queue.Queue()
+        self.frames = 0  # Ticks filed so far
+        self.written = 0
+        self.repeated = 0
+        self.dropped = 0
+        self.error = None
+        self.start = time.perf_counter()
+        self.thread = threading.Thread(target=self._write_frames, name="frame-writer", daemon=True)
+        self.thread.start()
+
+    def _tick(self):
+        return int((time.perf_counter() - self.start) * self.hz)
+
+    def capture(self, surface):
+        tick = self._tick()
+        if tick < self.frames:
+            return  # This tick already has its frame
+        if self.error is not None:
+            self.dropped += 1
+            return
+        try:
+            buffer = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        view = surface.get_view('1')
+        pixels = memoryview(view)
+        buffer[:] = pixels
+        pixels.release()
+        del view  # Unlocks the surface
+        self.pending.put((self.frames, tick, buffer))
+        self.frames = tick + 1
+
+    def _write_frames(self):
+        last = None
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            first, tick, buffer = item
+            if self.error is None:
+                try:
+                    if last is not None:
+                        for frame in range(first, tick):
+                            self.sink.repeat(frame, frame / self.hz, last)
+                            self.repeated += 1
+                    if buffer is not None:
+                        self.sink.write(tick, tick / self.hz, buffer)
+                        self.written += 1
+                except OSError as error:  # e.g. the encoder exited
+                    self.error = error
+            if buffer is not None:
+                if last is not None:
+                    self.free.put(last)
+                last = buffer
+
+    def close(self):
+        """Fill the ticks up to now, flush and close the sink; returns (written, repeated, dropped)."""
+        # Up to now, not past it: the tick that is under way has no frame yet
+        self.pending.put((self.frames, self._tick(), None))
+        self.pending.put(None)
+        self.thread.join()
+        try:
+            self.sink.close()
+        except OSError as error:
+            self.error = self.error or error
+        return self.written, self.repeated, self.dropped
+
+# --- Input ---
+# Everything the game reads from the player arrives as queued events,
+# drained once per frame just before the step: jump edges and held keys
+# alike, so they can never disagree about what happened when.
+INPUT_EVENTS = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP,
+                pygame.WINDOWFOCUSLOST, pygame.WINDOWFOCUSGAINED,
+                pygame.WINDOWMINIMIZED, pygame.WINDOWRESTORED, pygame.WINDOWEXPOSED)
+
+def filter_events():
+    """Have SDL drop every event type nothing here handles (mouse motion, text input, ...)."""
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(INPUT_EVENTS)
+
+class HeldKeys:
+    """Key state set by code that reads like ``pygame.key.get_pressed()``."""
+
+    def __init__(self, keys=()):
+        self.held = set(keys)
+
+    def __getitem__(self, key):
+        return key in self.held
+
+class InputLatency:
+    """Time from draining a key press to presenting the first frame stepped after it.
+
+    pygame events carry no SDL timestamp, so time spent in the queue before
+    the frame's drain is not included; the loops drain right before the
+    step, which keeps that to the wait for the frame deadline.
+    """
+
+    def __init__(self):
+        self.pending = deque()  # (frame, drained at), appended by the simulation
+
+    def sampled(self, frame, stamp):
+        self.pending.append((frame, stamp))
+
+    def presented(self, frame, now):
+        pending = self.pending
+        while pending and pending[0][0] <= frame:
+            metrics.time('input_latency', now - pending.popleft()[1])
+
+    def clear(self):
+        """Drop the samples not presented yet, e.g. when the game pauses."""
+        # A new deque rather than clear(), so a render thread part way
+        # through presented() can't popleft from under its own check
+        self.pending = deque()
+
+input_latency = InputLatency()
 
 # --- Screen & Font Setup ---
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.DOUBLEBUF)
-pygame.display.set_caption(GAME_TITLE)
+display = Display()
+screen = display.surface
+filter_events()
+recorder = None  # FrameRecorder while capturing
+
+def start_capture(path=None, command=None, queue_frames=CAPTURE_QUEUE_FRAMES):
+    """Record the screen at SIM_HZ to a chunked raw file or an encoder pipe."""
+    global recorder
+    if command is not None:
+        sink = PipeSink(command, screen)
+    else:
+        sink = RawChunkSink(path, screen)
+    recorder = FrameRecorder(sink, screen, queue_frames)
+
+def stop_capture():
+    global recorder
+    if recorder is None:
+        return
+    written, repeated, dropped = recorder.close()
+    if recorder.error is not None:
+        print(f"Capture stopped early: {recorder.error}", file=sys.stderr)
+    print(f"Captured {written + repeated} frames at {recorder.hz} FPS: {written} presented,"
+          f" {repeated} repeated ({dropped} dropped)", file=sys.stderr)
+    recorder = None
+
+def configure_display(**options):
+    """Reopen the display with Display(**options); ``screen`` follows it."""
+    global display, screen, GRADIENT_BACKGROUND
+    display = Display(**options)
+    screen = display.surface
+    filter_events()
+    # Shared surfaces made so far were prepared for the old target
+    GRADIENT_BACKGROUND = prepare_surface(GRADIENT_BACKGROUND)
+    _text_cache.clear()
+    _question_marks.clear()
+    _block_surfaces.clear()
+    _particle_stamps.clear()
+    _scaled_surfaces.clear()
+    Enemy.normal_surf = None
+    Player.frames = ()
+
+def present():
+    started = time.perf_counter()
+    if recorder is not None:
+        recorder.capture(screen)
+    display.present()
+    metrics.time('present', time.perf_counter() - started)
+
 clock = pygame.time.Clock()
 font = pygame.font.Font(None, 24)
 big_font = pygame.font.Font(None, 48)
+# SDL_ttf is not thread-safe; hold this around text rendering that can
+# overlap a level build on the loader thread
+font_lock = threading.Lock()
+
+# --- Surface Preparation ---
+# Blits are fastest between surfaces of one pixel format, so surfaces are
+# made in (or converted to) the format of ``screen``. Finished sprites go
+# through ``prepare_surface``: opaque ones are converted, ones whose pixels
+# are all fully opaque or fully clear get an RLE colorkey, and only real
+# translucency (antialiased text) keeps per-pixel alpha.
+SURFACE_COLORKEY = (255, 0, 255)
+
+def pixel_layout(surface):
+    """What decides whether a blit from ``surface`` needs converting: depth and colour masks."""
+    return surface.get_bitsize(), surface.get_masks()[:3]
+
+def opaque_surface(size):
+    """A blank surface in the render target's format."""
+    return pygame.Surface(size, 0, screen)
+
+def keyed_surface(size, colorkey=SURFACE_COLORKEY, rle=True):
+    """A surface in the render target's format, cleared to a transparent ``colorkey``.
+
+    RLE makes blits skip transparent runs but drawing into the surface
+    slower, so leave it off for surfaces that are redrawn often.
+    """
+    surf = opaque_surface(size)
+    surf.fill(colorkey)
+    surf.set_colorkey(colorkey, pygame.RLEACCEL if rle else 0)
+    return surf
+
+def prepare_surface(surf, rle=True):
+    """``surf`` in its fastest form for blitting onto the screen; it looks the same."""
+    if not surf.get_flags() & pygame.SRCALPHA:
+        return surf.convert(screen)
+    alphas = pygame.image.tobytes(surf, 'RGBA')[3::4]
+    clear = alphas.count(0)
+    if not clear and alphas.count(255) == len(alphas):
+        return surf.convert(screen)
+    if clear + alphas.count(255) == len(alphas):
+        keyed = keyed_surface(surf.get_size(), rle=rle)
+        # Copied through convert rather than blitted, so no alpha lands in the padding byte
+        pygame.mask.from_surface(surf).to_surface(keyed, setsurface=surf.convert(screen),
+                                                  unsetcolor=SURFACE_COLORKEY)
+        # Only usable if no opaque pixel happens to be the key colour
+        if pygame.mask.from_threshold(keyed, SURFACE_COLORKEY, (1, 1, 1, 255)).count() == clear:
+            return keyed
+    if pygame.display.get_surface() is None:
+        return surf  # The 'renderer' backend has no window surface to convert to
+    return surf.convert_alpha()
+
+# --- Blit Audit ---
+class BlitAudit:
+    """Counts blits whose source pixel layout differs from the target's.
+
+    Each such blit converts every pixel on the way, a silent multiplier on
+    frame cost. Counts are kept per call site and layout pair; the first
+    blit of each kind is logged as it happens, and ``report`` lists them all.
+    """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.counts = {}
+
+    def check(self, target, sources, depth=1):
+        """Record the blits of ``sources`` onto ``target`` made by the caller ``depth`` frames up."""
+        layout = pixel_layout(target)
+        site = None
+        for source in sources:
+            source_layout = pixel_layout(source)
+            if source_layout == layout:
+                continue
+            if site is None:
+                frame = sys._getframe(depth)
+                site = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+            key = (site, source_layout, layout)
+            count = self.counts.get(key, 0)
+            if not count:
+                print(f"Mismatched blit at {site}: {self.describe(source_layout)} onto "
+                      f"{self.describe(layout)}", file=self.stream)
+            self.counts[key] = count + 1
+            metrics.count('mismatched_blits')
+
+    @staticmethod
+    def describe(layout):
+        bits, masks = layout
+        order = ''.join(channel for mask, channel in sorted(zip(masks, 'RGB'), reverse=True))
+        return f"{bits}-bit {order}"
+
+    def report(self):
+        if not self.counts:
+            print("No mismatched blits", file=self.stream)
+            return
+        print("Mismatched blits by call site:", file=self.stream)
+        for (site, source, target), count in sorted(self.counts.items(), key=lambda item: -item[1]):
+            print(f"  {count:8d}  {site}: {self.describe(source)} onto {self.describe(target)}",
+                  file=self.stream)
+
+blit_audit = None  # BlitAudit while --audit-blits is on
+
+# --- Frame Pacing ---
+# Frames are due at absolute deadlines start + n / hz, so a late wake-up
+# shortens the next wait instead of pushing every later frame back.
+PACING_STRATEGIES = ('sleep', 'spin', 'vsync')
+PACING_SPIN_MS = 2.0  # 'spin' sleeps until this close to the deadline, then busy-waits
+PACING = 'sleep'
+
+def configure_pacing(strategy):
+    global PACING
+    if strategy not in PACING_STRATEGIES:
+        raise ValueError(f"unknown pacing strategy {strategy!r}")
+    PACING = strategy
+
+class FramePacer:
+    """Waits for the next frame deadline at ``hz`` frames per second.
+
+    Strategies:
+      'sleep'  time.sleep until the deadline; as exact as the OS timer
+      'spin'   sleep until PACING_SPIN_MS before the deadline, then spin
+      'vsync'  sleep until the deadline, then presenting also waits for
+               the display's vblank so frames don't tear; needs a display
+               opened with vsync, otherwise falls back to 'spin'
+
+    Frames are paced at ``hz`` under every strategy, so the simulation runs
+    at the same rate whatever the display refreshes at, and a frame whose
+    present was skipped (see ``same_picture``) still waits its turn.
+
+    Every frame records its jitter (how far the time between frames was
+    from 1/hz) in ``metrics``, unless ``measure`` is off for a second pacer
+    running beside the one that does. A frame more than half a period late
+    counts as a missed deadline; one more than a whole period late gives up
+    on the schedule and starts a new one from now rather than rushing
+    frames out to catch up.
+
+    ``wait`` blocks; a coroutine awaits ``asyncio.sleep(pacer.advance())``
+    and then calls ``started`` instead.
+    """
+
+    def __init__(self, hz, strategy=None, measure=True):
+        strategy = PACING if strategy is None else strategy
+        if strategy == 'vsync' and not display.vsync:
+            strategy = 'spin'
+        self.strategy = strategy
+        self.period = 1.0 / hz
+        self.measure = measure
+        self.deadline = None
+        self.last = None
+
+    def reset(self):
+        """Forget the schedule, e.g. after sleeping while paused."""
+        self.deadline = self.last = None
+
+    def advance(self):
+        """Move on to the next frame's deadline; returns the seconds left until it."""
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.period
+        return self.deadline - now
+
+    def wait(self):
+        """Block until the next frame is due; returns the time it started."""
+        remaining = self.advance()
+        if self.strategy == 'spin':
+            spin = PACING_SPIN_MS / 1000
+            if remaining > spin:
+                time.sleep(remaining - spin)
+            while time.perf_counter() < self.deadline:
+                pass
+        elif remaining > 0:
+            time.sleep(remaining)
+        return self.started()
+
+    def started(self):
+        """Record that the frame due at the deadline has started; returns the time it did."""
+        now = time.perf_counter()
+        if self.measure:
+            clock.tick()  # Only measures, for the FPS counter
+            if self.last is not None:
+                metrics.time('jitter', abs(now - self.last - self.period))
+        self.last = now
+        late = now - self.deadline
+        if late > self.period / 2:
+            if self.measure:
+                metrics.count('missed_deadlines')
+            if late > self.period:
+                self.deadline = now
+        return now
 
 # --- Pre-render gradient background ---
 def create_gradient_background():
-    background = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+    background = opaque_surface((SCREEN_WIDTH, SCREEN_HEIGHT))
     for y in range(SCREEN_HEIGHT):
         ratio = y / SCREEN_HEIGHT
         color = [
@@ -65,7 +889,7 @@ GRADIENT_BACKGROUND = create_gradient_background()
 
 # --- Particle System ---
 class Particle:
-    def __init__(self, x, y, vx, vy, color, life=30):
+    def __init__(self, x, y, vx, vy, color, life=PARTICLE_LIFE_TICKS):
         self.x = float(x)
         self.y = float(y)
         self.vx = float(vx)
@@ -75,25 +899,24 @@ class Particle:
         self.max_life = float(life)
         
     def update(self):
-        self.x += self.vx
-        self.y += self.vy
-        self.vy += 0.3
-        self.life -= 1
-        
-    def draw(self, screen):
-        if self.life > 0:
-            alpha = self.life / self.max_life
-            size = int(4 * alpha)
-            if size > 0:
-                pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), size)
+        h = SIM_TICKS
+        self.x += self.vx * h
+        # Exact for any step size: the position lags half a tick of gravity
+        # behind the velocity, as it does when stepping one tick at a time
+        self.y += (self.vy + PARTICLE_GRAVITY * (h - 1) / 2) * h
+        self.vy += PARTICLE_GRAVITY * h
+        self.life -= h
 
-# --- Global particle list with limit ---
-particles = []
+# --- Particle lists with limit ---
+# Each Game has its own list, which the player of its level shares.
 MAX_PARTICLES = 100
 
-def add_particle(x, y, vx, vy, color, life=30):
+def add_particle(particles, x, y, vx, vy, color, life=PARTICLE_LIFE_TICKS):
     if len(particles) < MAX_PARTICLES:
         particles.append(Particle(x, y, vx, vy, color, life))
+        metrics.count('particles_spawned')
+    else:
+        metrics.count('particles_dropped')
 
 # --- Enhanced Level Data with Connectors ---
 LEVEL_DATA = {
@@ -174,58 +997,907 @@ LEVEL_DATA = {
     }
 }
 
-# --- Enhanced Player Class with SM64DS Mechanics ---
-class Player(pygame.sprite.Sprite):
+# --- Procedural Levels ---
+GROUND_TOP = SCREEN_HEIGHT - 40
+GENERATED_MARGIN = 200  # Kept clear of blocks at the start and before the exit
+ENEMY_HEIGHT = 32
+
+def generate_level(seed, blocks=200, density=0.35, enemies=10, question_ratio=0.1,
+                   reachable=True, block_size=40):
+    """A random level in the LEVEL_DATA schema; the same arguments give the same level.
+
+    ``blocks`` floating brick/question blocks are scattered over the rows
+    above the ground, filling each cell with probability ``density``, so the
+    level grows to the right as needed. ``question_ratio`` of them are
+    question blocks (each one bursts into particles when hit). With
+    ``reachable`` the ground is unbroken and the lowest 80px above it kept
+    clear, so the exit can always be walked to; otherwise there are pits.
+    The world is as wide as it needs to be, which can be far wider than the
+    screen; the view then scrolls to follow the player.
+    """
+    rng = random.Random(seed)
+    top_row = 80  # Leave room for the HUD
+    clearance = 80 if reachable else 0
+    rows = [y for y in range(GROUND_TOP - clearance - block_size, top_row - 1, -block_size)]
+    if not rows:
+        raise ValueError(f"no room for {block_size}px blocks")
+    density = max(0.01, min(1.0, density))
+
+    platforms = []
+    column = 0
+    x0 = GENERATED_MARGIN
+    while len(platforms) < blocks:
+        x = x0 + column * block_size
+        for y in rows:
+            if len(platforms) < blocks and rng.random() < density:
+                block_type = 'question' if rng.random() < question_ratio else 'brick'
+                platforms.append((x, y, block_size, block_size, block_type))
+        column += 1
+    width = x0 + column * block_size + GENERATED_MARGIN
+
+    # Ground, broken by pits unless the level has to be reachable
+    ground = []
+    if reachable:
+        ground.append((0, GROUND_TOP, width, 40, 'ground'))
+    else:
+        start = 0
+        x = x0
+        while x < width - GENERATED_MARGIN:
+            if rng.random() < 0.05:
+                pit = rng.randint(2, 3) * 40
+                ground.append((start, GROUND_TOP, x - start, 40, 'ground'))
+                start = x + pit
+                x = start
+            x += 40
+        ground.append((start, GROUND_TOP, width - start, 40, 'ground'))
+
+    exit_x = width - GENERATED_MARGIN // 2 - 30
+    pipe = (exit_x, GROUND_TOP - 100, 60, 100, 'pipe')
+
+    spawns = []
+    for _ in range(enemies):
+        x = rng.randrange(x0, width - GENERATED_MARGIN)
+        if any(left <= x and x + 32 <= left + w for left, _, w, _, _ in ground):
+            spawns.append((x, GROUND_TOP - ENEMY_HEIGHT))
+
+    return {
+        'platforms': ground + platforms + [pipe],
+        'enemies': spawns,
+        'start_pos': (100, GROUND_TOP - 60),
+        'exit_pos': (exit_x + 30, GROUND_TOP - 100),
+    }
+
+def add_level(data):
+    """Register level data after the built-in levels; returns its number."""
+    number = max(LEVEL_DATA) + 1
+    LEVEL_DATA[number] = data
+    return number
+
+# --- Level Files ---
+# A level being designed lives in a JSON file in the LEVEL_DATA schema, with
+# lists for tuples and null for no exit. LevelWatcher notices when it is
+# saved and applies the change to the running level in place.
+LEVEL_WATCH_INTERVAL = 0.5  # Seconds between checks of a watched level file
+
+def parse_level(text):
+    """Level data from the JSON text of a level file; ValueError if it is malformed."""
+    raw = json.loads(text)
+    try:
+        platforms = [(int(x), int(y), int(w), int(h), str(block_type))
+                     for x, y, w, h, block_type in raw['platforms']]
+        enemies = [(int(x), int(y)) for x, y in raw['enemies']]
+        start_pos = tuple(int(v) for v in raw['start_pos'])
+        exit_pos = raw.get('exit_pos')
+        exit_pos = None if exit_pos is None else tuple(int(v) for v in exit_pos)
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"not a level: {error!r}") from None
+    for platform in platforms:
+        if platform[4] not in BLOCK_TYPES:
+            raise ValueError(f"unknown block type {platform[4]!r}")
+        if platform[2] <= 0 or platform[3] <= 0:
+            raise ValueError(f"empty block {platform}")
+    if len(start_pos) != 2 or (exit_pos is not None and len(exit_pos) != 2):
+        raise ValueError("start_pos and exit_pos are [x, y]")
+    return {'platforms': platforms, 'enemies': enemies,
+            'start_pos': start_pos, 'exit_pos': exit_pos}
+
+def write_level_file(path, data):
+    """Write ``data`` as a level file, one block or enemy per line."""
+    lines = ['{', '  "platforms": [']
+    lines.append(',\n'.join(f'    {json.dumps(list(p))}' for p in data['platforms']))
+    lines.append('  ],')
+    lines.append('  "enemies": [')
+    lines.append(',\n'.join(f'    {json.dumps(list(e))}' for e in data['enemies']))
+    lines.append('  ],')
+    lines.append(f'  "start_pos": {json.dumps(list(data["start_pos"]))},')
+    exit_pos = data['exit_pos']
+    lines.append(f'  "exit_pos": {json.dumps(None if exit_pos is None else list(exit_pos))}')
+    lines.append('}')
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+class LevelWatcher:
+    """Reloads a level file when it changes and applies it to the running game.
+
+    ``poll`` is cheap enough to call every frame: it stats the file at most
+    every LEVEL_WATCH_INTERVAL seconds. A file that doesn't parse (often a
+    save caught half-written) is reported and the level plays on unchanged.
+    """
+
+    def __init__(self, path, number, interval=LEVEL_WATCH_INTERVAL):
+        self.path = path
+        self.number = number
+        self.interval = interval
+        self.next_check = 0.0
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        return info.st_mtime_ns, info.st_size
+
+    def poll(self, game):
+        """Apply the file to ``game`` if it changed; True if the level was edited."""
+        now = time.monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.interval
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        try:
+            with open(self.path) as file:
+                data = parse_level(file.read())
+        except (OSError, ValueError) as error:
+            print(f"{self.path}: {error}", file=sys.stderr)
+            return False
+        LEVEL_DATA[self.number] = data
+        if game.number != self.number or game.level.number != self.number:
+            return False  # Picked up the next time the level is built
+        started = time.perf_counter()
+        blocks_added, blocks_removed, enemies_added, enemies_removed = game.level.apply(data)
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"{self.path}: +{blocks_added}/-{blocks_removed} blocks, "
+              f"+{enemies_added}/-{enemies_removed} enemies in {elapsed:.1f} ms", file=sys.stderr)
+        return True
+
+# --- Entity-Component Store ---
+# Entities are plain integer ids. Every component field is a column (one list
+# indexed by id), so systems walk flat arrays for just the entities that carry
+# a component instead of dispatching a method on every sprite.
+KIND_PLAYER = 'player'
+KIND_PLATFORM = 'platform'
+KIND_ENEMY = 'enemy'
+
+# Draw layers; the player is drawn behind blocks so pipes hide it on entry
+LAYER_PLAYER = 0
+LAYER_PLATFORM = 1
+LAYER_ENEMY = 2
+
+COLLISION_CELL_SIZE = 64
+BLOCK_BOUNCE_HEIGHT = 5
+ENEMY_WALK_FRAME_TICKS = 6  # ~100ms per foot position
+
+class SpatialGrid:
+    """Uniform grid of cells mapping to the collider ids that overlap them."""
+
+    def __init__(self, cell_size=COLLISION_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cells(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
+
+    def insert(self, eid, rect):
+        for cell in self._cells(rect):
+            self.cells.setdefault(cell, []).append(eid)
+
+    def remove(self, eid, rect):
+        for cell in self._cells(rect):
+            bucket = self.cells.get(cell)
+            if bucket and eid in bucket:
+                bucket.remove(eid)
+                if not bucket:
+                    del self.cells[cell]
+
+    def query(self, rect):
+        found = set()
+        cells = self.cells
+        for cell in self._cells(rect):
+            bucket = cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        return found
+
+def coalesce(shapes):
+    """Merge [rect, members] pairs that touch along a whole shared edge.
+
+    Rows of equal top and height are joined first, then columns of equal
+    left and width, so a strip of blocks or a stack of them becomes one
+    rect. Rects are copied; members are concatenated in order.
+    """
+    rows = []
+    for rect, members in sorted(shapes, key=lambda shape: (shape[0].top, shape[0].height, shape[0].left)):
+        last = rows[-1][0] if rows else None
+        if last and last.top == rect.top and last.height == rect.height and rect.left <= last.right:
+            last.width = max(last.right, rect.right) - last.left
+            rows[-1][1].extend(members)
+        else:
+            rows.append([rect.copy(), list(members)])
+    columns = []
+    for rect, members in sorted(rows, key=lambda shape: (shape[0].left, shape[0].width, shape[0].top)):
+        last = columns[-1][0] if columns else None
+        if last and last.left == rect.left and last.width == rect.width and rect.top <= last.bottom:
+            last.height = max(last.bottom, rect.bottom) - last.top
+            columns[-1][1].extend(members)
+        else:
+            columns.append([rect, members])
+    return columns
+
+class EntityStore:
+    """Columnar component storage for every entity in a level.
+
+    Components and their columns:
+      transform  x, y, rect, surf, layer
+      velocity   vx, vy
+      collider   block_type, collider_bounds (indexed in ``grid``), baked
+      animation  anim_timer, anim_frame, bounce, rest_y, was_hit
+      AI         alive, patrol_min, patrol_max, squish_timer
+
+    All columns are allocated for every entity; ``solids`` and ``walkers``
+    list the ids that actually carry the collider and AI components, in
+    creation order. ``movers`` lists the entities that are not in the
+    collider grid (player and enemies).
+
+    Collision does not test blocks one by one. ``compile_colliders`` merges
+    the solids into ``shapes``: as few rects as cover them, with no seams
+    between neighbouring blocks, indexed in ``shape_grid``. Pipes are
+    merged only with pipes, since they let the player pass up through them.
+    ``shape_members`` keeps the blocks behind each shape for ``hit``, and
+    ``recompile_colliders`` redoes just the shapes around edited blocks.
+
+    ``active`` is the set of entities with a running one-off animation,
+    mapped to the task that advances it. An entity registers itself with
+    ``activate`` when the animation starts and is dropped when its task
+    returns False, so idle entities cost nothing per frame.
+    """
+
     def __init__(self):
+        self.count = 0
+        # Identity
+        self.kind = []
+        self.view = []
+        self.live = []
+        # Transform
+        self.x = []
+        self.y = []
+        self.rect = []
+        self.surf = []
+        self.layer = []
+        # Velocity
+        self.vx = []
+        self.vy = []
+        # Collider
+        self.block_type = []
+        self.collider_bounds = []
+        self.baked = []
+        # Animation
+        self.anim_timer = []
+        self.anim_frame = []
+        self.bounce = []
+        self.rest_y = []
+        self.was_hit = []
+        # AI
+        self.alive = []
+        self.patrol_min = []
+        self.patrol_max = []
+        self.squish_timer = []
+        # Component membership
+        self.solids = []
+        self.walkers = []
+        self.walker_rects = []
+        self.movers = []
+        self.mover_rects = []
+        self.grid = SpatialGrid()
+        self.static_layer = None
+        self.dynamic = None  # Ids of the entities that are not baked, worked out again when needed
+        self.active = {}
+        # Collision shapes, rebuilt from ``solids`` when they change
+        self.shapes = []
+        self.shape_type = []
+        self.shape_members = []
+        self.shape_first = []
+        self.shape_of = {}
+        self.shape_grid = SpatialGrid()
+        self.shapes_stale = False
+
+    def create(self, kind, surf, rect, layer=0):
+        eid = self.count
+        self.count += 1
+        self.kind.append(kind)
+        self.view.append(None)
+        self.live.append(True)
+        self.x.append(float(rect.x))
+        self.y.append(float(rect.y))
+        self.rect.append(rect)
+        self.surf.append(surf)
+        self.layer.append(layer)
+        self.vx.append(0.0)
+        self.vy.append(0.0)
+        self.block_type.append(None)
+        self.collider_bounds.append(None)
+        self.baked.append(False)
+        self.anim_timer.append(0)
+        self.anim_frame.append(0)
+        self.bounce.append(0)
+        self.rest_y.append(rect.y)
+        self.was_hit.append(False)
+        self.alive.append(True)
+        self.patrol_min.append(0.0)
+        self.patrol_max.append(0.0)
+        self.squish_timer.append(0)
+        self.movers.append(eid)
+        self.mover_rects.append(rect)
+        self.dynamic = None
+        return eid
+
+    def add_collider(self, eid, block_type):
+        self.block_type[eid] = block_type
+        bounds = self.rect[eid].copy()
+        if block_type == 'question':
+            # Cover the whole bounce so a moving block is never missed
+            bounds.inflate_ip(0, 2 * BLOCK_BOUNCE_HEIGHT)
+        self.collider_bounds[eid] = bounds
+        self.grid.insert(eid, bounds)
+        self.solids.append(eid)
+        self.shapes_stale = True
+        self._remove_mover(eid)
+
+    def add_ai(self, eid, speed, patrol_range):
+        self.vx[eid] = float(speed)
+        self.patrol_min[eid], self.patrol_max[eid] = patrol_range
+        self.walkers.append(eid)
+        self.walker_rects.append(self.rect[eid])
+
+    def destroy(self, eid):
+        if not self.live[eid]:
+            return
+        self.live[eid] = False
+        if self.collider_bounds[eid] is not None:
+            self.grid.remove(eid, self.collider_bounds[eid])
+            self.solids.remove(eid)
+            self.shapes_stale = True
+        self.active.pop(eid, None)
+        if eid in self.walkers:
+            index = self.walkers.index(eid)
+            del self.walkers[index]
+            del self.walker_rects[index]
+        self._remove_mover(eid)
+
+    def _remove_mover(self, eid):
+        if eid in self.movers:
+            index = self.movers.index(eid)
+            del self.movers[index]
+            del self.mover_rects[index]
+
+    def activate(self, eid, task):
+        """Run ``task(store, eid)`` every frame until it returns False."""
+        self.active[eid] = task
+
+    def deactivate(self, eid):
+        self.active.pop(eid, None)
+
+    def _merge_solids(self, eids):
+        """(first member, rect, shape type, members) for the merged ``eids``."""
+        rects, block_type = self.rect, self.block_type
+        by_type = {}
+        for eid in eids:
+            shape_type = 'pipe' if block_type[eid] == 'pipe' else 'solid'
+            # Question blocks collide at rest; the bounce is only for show
+            rect = pygame.Rect(rects[eid].x, self.rest_y[eid], rects[eid].w, rects[eid].h)
+            by_type.setdefault(shape_type, []).append([rect, [eid]])
+        shapes = [(members[0], rect, shape_type, members)
+                  for shape_type, blocks in by_type.items()
+                  for rect, members in coalesce(blocks)]
+        shapes.sort(key=lambda shape: shape[0])
+        return shapes
+
+    def _add_shape(self, first, rect, shape_type, members):
+        index = len(self.shapes)
+        self.shapes.append(rect)
+        self.shape_type.append(shape_type)
+        self.shape_members.append(members)
+        self.shape_first.append(first)
+        self.shape_grid.insert(index, rect)
+        for eid in members:
+            self.shape_of[eid] = index
+
+    def compile_colliders(self):
+        """Rebuild the collision shapes from the current solids."""
+        self.shapes = []
+        self.shape_type = []
+        self.shape_members = []
+        self.shape_first = []
+        self.shape_of = {}
+        self.shape_grid = SpatialGrid(self.grid.cell_size)
+        for shape in self._merge_solids(self.solids):
+            self._add_shape(*shape)
+        self.shapes_stale = False
+
+    def recompile_colliders(self, dirty):
+        """Rebuild only the collision shapes near the ``dirty`` rects.
+
+        Shapes touching a dirty rect are dropped, and their remaining blocks
+        are merged again with any solids that have no shape yet; every other
+        shape keeps its index and grid cells. A dropped shape leaves None in
+        ``shapes`` until the next full ``compile_colliders``.
+        """
+        shapes, live, shape_of = self.shapes, self.live, self.shape_of
+        touched = set()
+        for rect in dirty:
+            near = rect.inflate(2, 2)  # Shapes that merely share an edge merge too
+            touched.update(index for index in self.shape_grid.query(near)
+                           if shapes[index].colliderect(near))
+        eids = [eid for eid in self.solids if eid not in shape_of]
+        for index in touched:
+            members = self.shape_members[index]
+            eids.extend(eid for eid in members if live[eid])
+            for eid in members:
+                del shape_of[eid]
+            self.shape_grid.remove(index, shapes[index])
+            shapes[index] = None
+            self.shape_members[index] = []
+        for shape in self._merge_solids(eids):
+            self._add_shape(*shape)
+        self.shapes_stale = False
+        return len(touched)
+
+    def collide_shapes(self, rect):
+        """Indices of collision shapes overlapping ``rect``, in creation order."""
+        if self.shapes_stale:
+            self.compile_colliders()
+        shapes = self.shapes
+        hits = [index for index in self.shape_grid.query(rect) if shapes[index].colliderect(rect)]
+        # Same order as the blocks they came from
+        hits.sort(key=self.shape_first.__getitem__)
+        return hits
+
+    def shape_block(self, index, rect):
+        """The first block of shape ``index`` that ``rect`` touches."""
+        members = self.shape_members[index]
+        bounds = self.collider_bounds
+        for eid in members:
+            if bounds[eid].colliderect(rect):
+                return eid
+        return members[0]
+
+    def first_walker_hit(self, rect):
+        """Id of the first AI entity overlapping ``rect``, or None."""
+        index = rect.collidelist(self.walker_rects)
+        if index < 0:
+            return None
+        return self.walkers[index]
+
+    def visible(self, viewport):
+        """Ids of entities overlapping ``viewport``, in draw order.
+
+        Blocks baked into the static layer are drawn with it and left out.
+        """
+        rects, baked = self.rect, self.baked
+        found = [eid for eid in self.grid.query(viewport)
+                 if not baked[eid] and rects[eid].colliderect(viewport)]
+        movers = self.movers
+        found.extend(movers[i] for i in viewport.collidelistall(self.mover_rects))
+        layer = self.layer
+        found.sort(key=lambda eid: (layer[eid], eid))
+        return found
+
+    # Columns that change during play; everything else is fixed at build time
+    SNAPSHOT_COLUMNS = ('live', 'x', 'y', 'surf', 'vx', 'vy', 'anim_timer', 'anim_frame',
+                        'bounce', 'was_hit', 'alive', 'squish_timer')
+
+    def _dynamic_ids(self):
+        if self.dynamic is None:
+            baked = self.baked
+            ids = tuple(eid for eid in range(self.count) if not baked[eid])
+            # itemgetter of one index returns the item rather than a 1-tuple
+            gather = operator.itemgetter(*ids) if len(ids) != 1 else lambda column: (column[ids[0]],)
+            self.dynamic = (ids, gather)
+        return self.dynamic
+
+    def snapshot(self):
+        """Copy of the mutable component state, for ``restore``.
+
+        Baked blocks never change while the level is played, so the columns
+        are only copied for the other entities (``state['ids']``); on a big
+        level that is a small fraction of them.
+        """
+        ids, gather = self._dynamic_ids()
+        state = {name: gather(getattr(self, name)) for name in self.SNAPSHOT_COLUMNS}
+        state['ids'] = ids
+        state['gather'] = gather
+        state['count'] = self.count
+        state['solids'] = list(self.solids)
+        state['walkers'] = list(self.walkers)
+        state['movers'] = list(self.movers)
+        state['active'] = dict(self.active)
+        rects = self.rect
+        # Only movers and animating entities ever leave their build position
+        state['moved'] = {eid: tuple(rects[eid]) for eid in self.movers}
+        state['moved'].update((eid, tuple(rects[eid])) for eid in self.active)
+        return state
+
+    def restore(self, state):
+        """Put the store back to ``state`` in place, reusing every surface and rect.
+
+        Returns the ids that were destroyed since the snapshot and are live
+        again, so their views can rejoin their sprite groups.
+        """
+        count = state['count']
+        ids, gather = state['ids'], state['gather']
+        live = self.live
+        revived = []
+        if gather(live) != state['live']:
+            revived = [eid for eid, was_live in zip(ids, state['live']) if was_live and not live[eid]]
+        rects = self.rect
+        for eid in self.active:
+            if eid < count and self.kind[eid] == KIND_PLATFORM:
+                rects[eid].y = self.rest_y[eid]
+        if count < self.count:
+            for name in self.SNAPSHOT_COLUMNS + ('kind', 'view', 'rect', 'layer', 'block_type',
+                                                 'collider_bounds', 'baked', 'rest_y', 'patrol_min',
+                                                 'patrol_max'):
+                del getattr(self, name)[count:]
+            self.count = count
+            self.dynamic = None
+        # Only write back the columns that differ; between nearby states most don't
+        for name in self.SNAPSHOT_COLUMNS:
+            column, saved = getattr(self, name), state[name]
+            if gather(column) != saved:
+                for eid, value in zip(ids, saved):
+                    column[eid] = value
+        for eid, saved in state['moved'].items():
+            rects[eid].update(saved)
+        if self.solids != state['solids']:
+            self.solids[:] = state['solids']
+            self.grid = SpatialGrid(self.grid.cell_size)
+            for eid in self.solids:
+                self.grid.insert(eid, self.collider_bounds[eid])
+            self.shapes_stale = True
+        self.walkers[:] = state['walkers']
+        self.walker_rects[:] = [rects[eid] for eid in self.walkers]
+        self.movers[:] = state['movers']
+        self.mover_rects[:] = [rects[eid] for eid in self.movers]
+        self.active.clear()
+        self.active.update(state['active'])
+        return revived
+
+# --- Static Layer ---
+STATIC_CHUNK_SIZE = 512
+STATIC_CHUNK_MARGIN = 1  # Chunks around the view kept composited; farther ones are dropped
+STATIC_LAYER_COLORKEY = (255, 0, 255)
+
+class StaticLayer:
+    """Blocks that never change, pre-composited into chunk surfaces.
+
+    Chunks are STATIC_CHUNK_SIZE squares keyed by chunk coordinates and only
+    exist where there are blocks, so one blit covers many blocks. ``bake``
+    only records which chunks a block is in; ``items`` composites a chunk
+    when it first comes into view and drops the ones more than
+    STATIC_CHUNK_MARGIN chunks away, so memory follows the view rather than
+    the size of the level. Baked blocks are skipped by EntityStore.visible;
+    ``unbake`` hands a block back to the per-entity draw path and redraws
+    the chunks it touched.
+    """
+
+    def __init__(self, store, chunk_size=STATIC_CHUNK_SIZE):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.members = {}
+
+    def _keys(self, rect):
+        size = self.chunk_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
+
+    def _chunk(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = keyed_surface((self.chunk_size, self.chunk_size),
+                                                     STATIC_LAYER_COLORKEY)
+        return chunk
+
+    def bake(self, eid):
+        store = self.store
+        store.baked[eid] = True
+        store.dynamic = None
+        rect = store.rect[eid]
+        for key in self._keys(rect):
+            self.members.setdefault(key, []).append(eid)
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                continue  # Composited when it comes into view
+            if blit_audit is not None:
+                blit_audit.check(chunk, (store.surf[eid],))
+            chunk.blit(store.surf[eid], (rect.x - key[0] * self.chunk_size,
+                                         rect.y - key[1] * self.chunk_size))
+            invalidate_scaled(chunk)
+
+    def unbake(self, eid):
+        store = self.store
+        store.baked[eid] = False
+        store.dynamic = None
+        for key in self._keys(store.rect[eid]):
+            members = self.members.get(key)
+            if members and eid in members:
+                members.remove(eid)
+            if key in self.chunks or not members:
+                self.redraw(key)
+
+    def redraw(self, key):
+        """Recomposite one chunk from the blocks baked into it; returns the chunk, if any."""
+        members = self.members.get(key)
+        if not members:
+            self.chunks.pop(key, None)
+            self.members.pop(key, None)
+            return None
+        chunk = self._chunk(key)
+        chunk.fill(STATIC_LAYER_COLORKEY)
+        ox, oy = key[0] * self.chunk_size, key[1] * self.chunk_size
+        store = self.store
+        if blit_audit is not None:
+            blit_audit.check(chunk, [store.surf[eid] for eid in members])
+        chunk.blits([(store.surf[eid], (store.rect[eid].x - ox, store.rect[eid].y - oy))
+                     for eid in members], doreturn=False)
+        invalidate_scaled(chunk)
+        return chunk
+
+    def items(self, viewport):
+        """(surface, (x, y)) pairs for the chunks overlapping ``viewport``."""
+        size = self.chunk_size
+        chunks, members = self.chunks, self.members
+        items = []
+        for key in self._keys(viewport):
+            chunk = chunks.get(key)
+            if chunk is None and key in members:
+                chunk = self.redraw(key)
+            if chunk is not None:
+                items.append((chunk, (key[0] * size, key[1] * size)))
+        margin = STATIC_CHUNK_MARGIN
+        left, top = viewport.left // size - margin, viewport.top // size - margin
+        right, bottom = (viewport.right - 1) // size + margin, (viewport.bottom - 1) // size + margin
+        for key in [key for key in chunks
+                    if not (left <= key[0] <= right and top <= key[1] <= bottom)]:
+            del chunks[key]
+        return items
+
+# --- Default store for entities created without an explicit one ---
+entities = EntityStore()
+
+# --- Systems ---
+def enemy_ai_system(store, eids=None):
+    """Patrol live enemies and step their walk cycle."""
+    x, y, vx = store.x, store.y, store.vx
+    rects, surfs = store.rect, store.surf
+    alive = store.alive
+    patrol_min, patrol_max = store.patrol_min, store.patrol_max
+    anim_timer, anim_frame = store.anim_timer, store.anim_frame
+    walk_frames = Enemy.walk_frames
+    h = SIM_TICKS
+    for eid in (store.walkers if eids is None else eids):
+        if alive[eid]:
+            px = x[eid] + vx[eid] * h
+            x[eid] = px
+            if px < patrol_min[eid] or px > patrol_max[eid]:
+                vx[eid] *= -1
+            rect = rects[eid]
+            rect.x = int(px)
+            rect.y = int(y[eid])
+            timer = anim_timer[eid] + h
+            anim_timer[eid] = timer
+            frame = int(timer // ENEMY_WALK_FRAME_TICKS) % 2
+            if frame != anim_frame[eid]:
+                anim_frame[eid] = frame
+                surfs[eid] = walk_frames[frame]
+
+def active_system(store):
+    """Advance every registered animation; finished ones drop out of the set."""
+    active = store.active
+    for eid, task in list(active.items()):
+        if not task(store, eid) and active.get(eid) is task:
+            del active[eid]
+
+def update_systems(store):
+    enemy_ai_system(store)
+    active_system(store)
+
+# --- Active Tasks ---
+# A task advances one entity's animation by a step and returns False once
+# the animation is over.
+def block_bounce_task(store, eid):
+    """Bounce a block that has just been hit from below."""
+    timer = store.bounce[eid]
+    rect = store.rect[eid]
+    if timer <= 0:
+        return False
+    offset = math.sin(timer * 0.3) * BLOCK_BOUNCE_HEIGHT
+    rect.y = int(store.rest_y[eid] - offset)
+    timer -= SIM_TICKS
+    store.bounce[eid] = timer
+    if timer <= 0:
+        rect.y = store.rest_y[eid]
+        store.view[eid].draw_block()
+        return False
+    return True
+
+def squish_task(store, eid):
+    """Leave a stomped enemy on screen briefly, then remove it."""
+    store.squish_timer[eid] += SIM_TICKS
+    if store.squish_timer[eid] > SQUISH_TICKS:
+        store.view[eid].kill()
+        return False
+    return True
+
+# --- Entity Views ---
+class EntityView(pygame.sprite.Sprite):
+    """Sprite-compatible handle onto one entity of an EntityStore.
+
+    ``rect`` and ``surf`` are the store's own objects, so in-place changes
+    such as ``view.rect.y += 2`` are seen by every system. ``pos`` and ``vel``
+    return copies; assign to them to write back.
+    """
+
+    def __init__(self, kind, surf, rect, layer, store=None):
         super().__init__()
-        self.surf = pygame.Surface((32, 40), pygame.SRCALPHA)
-        self.rect = self.surf.get_rect(center=(100, SCREEN_HEIGHT - 100))
-        self.pos = pygame.math.Vector2(self.rect.topleft)
-        self.vel = pygame.math.Vector2(0, 0)
+        self.store = entities if store is None else store
+        self.eid = self.store.create(kind, surf, rect, layer)
+        self.store.view[self.eid] = self
+
+    @property
+    def rect(self):
+        return self.store.rect[self.eid]
+
+    @rect.setter
+    def rect(self, value):
+        self.store.rect[self.eid].update(value)
+
+    @property
+    def surf(self):
+        return self.store.surf[self.eid]
+
+    @surf.setter
+    def surf(self, value):
+        self.store.surf[self.eid] = value
+
+    @property
+    def pos(self):
+        return pygame.math.Vector2(self.store.x[self.eid], self.store.y[self.eid])
+
+    @pos.setter
+    def pos(self, value):
+        self.store.x[self.eid] = float(value[0])
+        self.store.y[self.eid] = float(value[1])
+
+    @property
+    def vel(self):
+        return pygame.math.Vector2(self.store.vx[self.eid], self.store.vy[self.eid])
+
+    @vel.setter
+    def vel(self, value):
+        self.store.vx[self.eid] = float(value[0])
+        self.store.vy[self.eid] = float(value[1])
+
+    def kill(self):
+        super().kill()
+        self.store.destroy(self.eid)
+
+    def update_active(self):
+        """Advance this entity's registered animation by one frame, if any."""
+        task = self.store.active.get(self.eid)
+        if task is not None and not task(self.store, self.eid):
+            self.store.deactivate(self.eid)
+
+LAST_LEVEL = max(LEVEL_DATA)
+
+# --- Enhanced Player Class with SM64DS Mechanics ---
+class Player(EntityView):
+    # The sprite only changes when the player blinks, so both looks are drawn
+    # once and shared: frames[0] with eyes open, frames[1] mid-blink. A
+    # surface handed to the renderer is then never drawn into, however many
+    # steps the simulation gets ahead of it.
+    frames = ()
+
+    def __init__(self, store=None):
+        if not Player.frames:
+            Player.pre_draw_player()
+        surf = Player.frames[0]
+        super().__init__(KIND_PLAYER, surf, surf.get_rect(center=(100, SCREEN_HEIGHT - 100)),
+                         LAYER_PLAYER, store)
         self.acc = pygame.math.Vector2(0, 0)
         self.is_grounded = False
         self.is_running = False
         self.jump_held = False
         self.jump_timer = 0
         self.facing_right = True
-        self.animation_timer = 0
         self.needs_redraw = True
+        self.drawing = True  # Off while a bot simulates ahead; redraws wait until it's back on
+        self.world_width = None  # Width of a level that scrolls; None wraps at the screen edges
+        self.wrapped = False  # Whether the last move wrapped around a screen edge
+        self.particles = []  # The playing Game's particle list
         self.draw_player()
-        
+
+    # Controller state kept on the view rather than in store columns
+    STATE_FIELDS = ('is_grounded', 'is_running', 'jump_held', 'jump_timer', 'facing_right')
+
+    def get_state(self):
+        return tuple(getattr(self, name) for name in self.STATE_FIELDS)
+
+    def set_state(self, state):
+        for name, value in zip(self.STATE_FIELDS, state):
+            setattr(self, name, value)
+        self.acc = pygame.math.Vector2(0, 0)
+        self.needs_redraw = True
+        self.draw_player()
+
+    @property
+    def animation_timer(self):
+        return self.store.anim_timer[self.eid]
+
+    @animation_timer.setter
+    def animation_timer(self, value):
+        self.store.anim_timer[self.eid] = value
+
+    @staticmethod
+    def pre_draw_player():
+        frames = []
+        for blinking in (False, True):
+            surf = pygame.Surface((32, 40), pygame.SRCALPHA)
+            # Enhanced Mario sprite with better proportions
+            # Overalls
+            pygame.draw.rect(surf, PLAYER_BLUE, (0, 20, 32, 20))
+            # Arms
+            pygame.draw.rect(surf, PLAYER_BLUE, (4, 16, 8, 4))
+            pygame.draw.rect(surf, PLAYER_BLUE, (20, 16, 8, 4))
+            # Shirt
+            pygame.draw.rect(surf, PLAYER_RED, (4, 12, 24, 12))
+            # Hat
+            pygame.draw.rect(surf, PLAYER_RED, (4, 0, 24, 8))
+            # Face
+            pygame.draw.rect(surf, PLAYER_SKIN, (8, 8, 16, 12))
+            # Hands
+            pygame.draw.rect(surf, PLAYER_SKIN, (0, 20, 6, 6))
+            pygame.draw.rect(surf, PLAYER_SKIN, (26, 20, 6, 6))
+            # Eyes
+            if not blinking:
+                pygame.draw.rect(surf, BLACK, (10, 10, 3, 4))
+                pygame.draw.rect(surf, BLACK, (19, 10, 3, 4))
+            frames.append(prepare_surface(surf))
+        Player.frames = tuple(frames)
+
     def draw_player(self):
-        if not self.needs_redraw:
+        if not self.needs_redraw or not self.drawing:
             return
-            
-        self.surf.fill((0, 0, 0, 0))
-        # Enhanced Mario sprite with better proportions
-        # Overalls
-        pygame.draw.rect(self.surf, PLAYER_BLUE, (0, 20, 32, 20))
-        # Arms
-        pygame.draw.rect(self.surf, PLAYER_BLUE, (4, 16, 8, 4))
-        pygame.draw.rect(self.surf, PLAYER_BLUE, (20, 16, 8, 4))
-        # Shirt
-        pygame.draw.rect(self.surf, PLAYER_RED, (4, 12, 24, 12))
-        # Hat
-        pygame.draw.rect(self.surf, PLAYER_RED, (4, 0, 24, 8))
-        # Face
-        pygame.draw.rect(self.surf, PLAYER_SKIN, (8, 8, 16, 12))
-        # Hands
-        pygame.draw.rect(self.surf, PLAYER_SKIN, (0, 20, 6, 6))
-        pygame.draw.rect(self.surf, PLAYER_SKIN, (26, 20, 6, 6))
-        # Eyes (animated)
-        if self.animation_timer % 120 < 110:  # Blink animation
-            pygame.draw.rect(self.surf, BLACK, (10, 10, 3, 4))
-            pygame.draw.rect(self.surf, BLACK, (19, 10, 3, 4))
-        
+        # Blink animation
+        self.surf = Player.frames[self.animation_timer % 120 >= 110]
         self.needs_redraw = False
 
-    def move(self):
+    def move(self, keys=None):
+        store, eid = self.store, self.eid
         self.acc = pygame.math.Vector2(0, GRAVITY)
-        keys = pygame.key.get_pressed()
-        
+        if keys is None:
+            keys = pygame.key.get_pressed()
+
         # SM64DS-style running
         self.is_running = keys[pygame.K_LSHIFT] or keys[pygame.K_z]
-        
+
         # Movement with momentum
         if keys[pygame.K_LEFT] or keys[pygame.K_a]:
             if self.is_running:
@@ -239,440 +1911,2771 @@ class Player(pygame.sprite.Sprite):
             else:
                 self.acc.x = PLAYER_WALK_ACC
             self.facing_right = True
-        
-        # Apply friction
-        if self.is_grounded:
-            self.vel.x *= PLAYER_FRICTION
-        else:
-            self.vel.x *= PLAYER_AIR_FRICTION
-            
-        # Speed limits
+
+        # Apply friction, decaying exponentially over the step
+        h = SIM_TICKS
+        friction = PLAYER_FRICTION if self.is_grounded else PLAYER_AIR_FRICTION
+        decay = friction ** h
+        # Speed that acceleration adds over the step against the decay (the
+        # sum of friction**k for the k ticks covered); exactly 1 for one tick
+        gain = (1 - decay) / (1 - friction)
+        vx = store.vx[eid] * decay
+
+        # Speed limits, shifted so the top speed with acceleration applied is
+        # the same at every step size
+        ax, ay = self.acc
         max_speed = MAX_RUN_SPEED if self.is_running else MAX_WALK_SPEED
-        self.vel.x = max(-max_speed, min(max_speed, self.vel.x))
-        
-        # Update position
-        self.vel += self.acc
-        self.pos += self.vel + 0.5 * self.acc
-        
-        # Screen wrapping - fixed to not interfere with pipes
-        if self.pos.x > SCREEN_WIDTH and self.vel.x > 0:
-            self.pos.x = 0
-        if self.pos.x < -32 and self.vel.x < 0:  # -32 to account for player width
-            self.pos.x = SCREEN_WIDTH
-        
-        self.rect.topleft = self.pos
-        self.animation_timer += 1
-        
+        shift = ax * (1 - gain)
+        limited = max(-max_speed + shift, min(max_speed + shift, vx))
+        clamped = limited != vx
+        vx = limited + ax * gain
+
+        # Update position. Stepping one tick at a time, position moves by the
+        # new speed plus half the acceleration; these are the closed forms of
+        # that over ``h`` ticks, so the path doesn't depend on the step size.
+        if clamped:
+            # Held at the speed limit, so there is no decay within the step
+            x = store.x[eid] + (vx + ax * 0.5) * h
+        else:
+            carry = friction * gain / decay
+            x = store.x[eid] + (vx * carry + ax * (1.5 * h + friction / (1 - friction) * (h - gain) - carry * gain))
+        vy = store.vy[eid] + ay * h
+        y = store.y[eid] + (vy + ay * (1 - h / 2)) * h
+
+        self.wrapped = False
+        if self.world_width is None:
+            # Screen wrapping - fixed to not interfere with pipes
+            if x > SCREEN_WIDTH and vx > 0:
+                x = 0
+                self.wrapped = True
+            if x < -32 and vx < 0:  # -32 to account for player width
+                x = SCREEN_WIDTH
+                self.wrapped = True
+        elif not 0 <= x <= self.world_width - self.rect.width:
+            # Levels wider than the screen scroll instead, and end at their edges
+            x = max(0, min(self.world_width - self.rect.width, x))
+            vx = 0.0
+
+        store.x[eid], store.y[eid] = float(x), y
+        store.vx[eid], store.vy[eid] = vx, vy
+        self.rect.topleft = (x, y)
+        self.animation_timer += h
+
         # Check if we need to redraw (blink animation)
-        if self.animation_timer % 10 == 0:
+        if crossed(self.animation_timer, h, 10):
             self.needs_redraw = True
 
     def jump(self):
         if self.is_grounded and not self.jump_held:
-            self.vel.y = PLAYER_JUMP_STRENGTH
+            self.store.vy[self.eid] = PLAYER_JUMP_STRENGTH
             self.is_grounded = False
             self.jump_held = True
             self.jump_timer = 0
             # Jump particles
-            for i in range(5):
-                add_particle(
-                    self.rect.centerx + random.randint(-10, 10),
-                    self.rect.bottom,
-                    random.uniform(-2, 2),
-                    random.uniform(-3, -1),
-                    random.choice(PARTICLE_COLORS)
-                )
-                
+            if self.particles is not None:
+                for i in range(5):
+                    add_particle(
+                        self.particles,
+                        self.rect.centerx + random.randint(-10, 10),
+                        self.rect.bottom,
+                        random.uniform(-2, 2),
+                        random.uniform(-3, -1),
+                        random.choice(PARTICLE_COLORS)
+                    )
+
     def update_jump(self):
         # Variable jump height (hold to jump higher)
-        if self.jump_held and self.jump_timer < 10 and self.vel.y < 0:
-            self.vel.y += PLAYER_JUMP_BOOST
-            self.jump_timer += 1
+        store, eid = self.store, self.eid
+        if self.jump_held and self.jump_timer < PLAYER_JUMP_BOOST_TICKS and store.vy[eid] < 0:
+            h = SIM_TICKS
+            boost = PLAYER_JUMP_BOOST * min(h, PLAYER_JUMP_BOOST_TICKS - self.jump_timer)
+            store.vy[eid] += boost
+            # The boost reaches the position a step late; keep that delay at
+            # one tick, as it is when stepping a tick at a time
+            store.y[eid] -= boost * (1 - h) / 2
+            self.jump_timer += h
 
-    def update(self, platforms):
-        self.move()
+    def update(self, platforms=None, keys=None):
+        # Collisions resolve against the store's collider index; ``platforms``
+        # is accepted for compatibility with Group.update call sites.
+        start_y = self.store.y[self.eid]
+        self.move(keys)
         self.update_jump()
         # Check Y collision first
-        self.rect.y = int(self.pos.y)
-        self.check_collision_y(platforms)
+        if SIM_TICKS > 1:
+            self.sweep_y(start_y)
+        else:
+            self.rect.y = int(self.store.y[self.eid])
+            self.check_collision_y()
         # Then X collision
-        self.rect.x = int(self.pos.x)
-        self.check_collision_x(platforms)
+        self.rect.x = int(self.store.x[self.eid])
+        self.check_collision_x()
         self.draw_player()  # Redraw only if needed
 
-    def check_collision_y(self, platforms):
-        hits = pygame.sprite.spritecollide(self, platforms, False)
+    def sweep_y(self, start_y):
+        """Resolve a vertical move longer than a tick in tick-sized pieces.
+
+        At low step rates a fast fall could otherwise pass straight through
+        a block between one step and the next.
+        """
+        store, eid = self.store, self.eid
+        end_y = store.y[eid]
+        pieces = math.ceil(SIM_TICKS)
+        for i in range(1, pieces + 1):
+            y = end_y if i == pieces else start_y + (end_y - start_y) * i / pieces
+            self.rect.y = int(y)
+            if self.check_collision_y():
+                return
+
+    def check_collision_y(self, platforms=None):
+        """Push the player out of any block it overlaps vertically; True on a hit."""
+        store, eid = self.store, self.eid
+        hits = store.collide_shapes(self.rect)
+        if not hits and store.vy[eid] > 0 and store.y[eid] > self.rect.y:
+            # The rect rounds down, so a fall of less than a pixel into the
+            # block below shows no overlap; count it as landing, or a player
+            # standing still sinks and snaps back at a rate set by SIM_HZ
+            hits = store.collide_shapes(self.rect.move(0, 1))
         if hits:
-            platform = hits[0]
-            if self.vel.y > 0:  # Moving down
-                self.rect.bottom = platform.rect.top
-                self.pos.y = float(self.rect.y)
-                self.vel.y = 0
+            shape = hits[0]
+            bounds = store.shapes[shape]
+            if store.vy[eid] > 0:  # Moving down
+                self.rect.bottom = bounds.top
+                store.y[eid] = float(self.rect.y)
+                store.vy[eid] = 0.0
                 self.is_grounded = True
-            elif self.vel.y < 0:  # Moving up
-                if hasattr(platform, 'block_type') and platform.block_type != 'pipe':
-                    self.rect.top = platform.rect.bottom
-                    self.pos.y = float(self.rect.y)
-                    self.vel.y = 0
+            elif store.vy[eid] < 0:  # Moving up
+                if store.shape_type[shape] != 'pipe':
+                    platform = store.view[store.shape_block(shape, self.rect)]
+                    self.rect.top = bounds.bottom
+                    store.y[eid] = float(self.rect.y)
+                    store.vy[eid] = 0.0
                     # Block hit effect
                     if platform.block_type == 'question':
                         platform.hit()
                         # Coin particles
-                        for i in range(8):
-                            add_particle(
-                                platform.rect.centerx,
-                                platform.rect.centery,
-                                random.uniform(-3, 3),
-                                random.uniform(-5, -2),
-                                random.choice(PARTICLE_COLORS)
-                            )
-                    
-    def check_collision_x(self, platforms):
-        hits = pygame.sprite.spritecollide(self, platforms, False)
+                        if self.particles is not None:
+                            for i in range(8):
+                                add_particle(
+                                    self.particles,
+                                    platform.rect.centerx,
+                                    platform.rect.centery,
+                                    random.uniform(-3, 3),
+                                    random.uniform(-5, -2),
+                                    random.choice(PARTICLE_COLORS)
+                                )
+            return True
+        return False
+
+    def check_collision_x(self, platforms=None):
+        store, eid = self.store, self.eid
+        hits = store.collide_shapes(self.rect)
         if hits:
-            platform = hits[0]
-            if self.vel.x > 0:  # Moving right
-                self.rect.right = platform.rect.left
-                self.pos.x = float(self.rect.x)
-                self.vel.x = 0
-            elif self.vel.x < 0:  # Moving left
-                self.rect.left = platform.rect.right
-                self.pos.x = float(self.rect.x)
-                self.vel.x = 0
+            bounds = store.shapes[hits[0]]
+            if store.vx[eid] > 0:  # Moving right
+                self.rect.right = bounds.left
+                store.x[eid] = float(self.rect.x)
+                store.vx[eid] = 0.0
+            elif store.vx[eid] < 0:  # Moving left
+                self.rect.left = bounds.right
+                store.x[eid] = float(self.rect.x)
+                store.vx[eid] = 0.0
 
 # --- Enhanced Platform Class ---
-class Platform(pygame.sprite.Sprite):
-    def __init__(self, x, y, w, h, block_type='ground'):
-        super().__init__()
+_question_marks = {}
+
+def question_mark(size):
+    """The "?" glyph for a question block, rendered once per font size."""
+    glyph = _question_marks.get(size)
+    if glyph is None:
+        with font_lock:
+            q_font = pygame.font.Font(None, size)
+            glyph = _question_marks[size] = prepare_surface(q_font.render("?", True, BLACK))
+    return glyph
+
+# Blocks of one kind and size look the same, so they share one surface per
+# look; keyed by (block_type, size, used) where used only changes a question
+# block. The surfaces are never drawn on again, which also keeps snapshots
+# that still reference an old look intact.
+_block_surfaces = {}
+
+def block_surface(block_type, size, used=False):
+    """The shared picture of a block; see _block_surfaces."""
+    key = (block_type, size, used)
+    surf = _block_surfaces.get(key)
+    if surf is None:
+        surf = _block_surfaces[key] = draw_block_surface(block_type, size, used)
+    return surf
+
+def draw_block_surface(block_type, size, used):
+    surf = opaque_surface(size)
+    w, h = size
+    if block_type == 'ground':
+        surf.fill(GROUND_COLOR)
+        # Add texture
+        for i in range(0, w, 8):
+            if i + 4 < w:
+                pygame.draw.line(surf, (200, 120, 40), (i, 0), (i+4, 8), 2)
+    elif block_type == 'brick':
+        surf.fill(BRICK_COLOR)
+        for i in range(0, int(w), 16):
+            pygame.draw.line(surf, BRICK_MORTAR_COLOR, (i, 0), (i, h), 2)
+        for i in range(0, int(h), 16):
+            pygame.draw.line(surf, BRICK_MORTAR_COLOR, (0, i), (w, i), 2)
+    elif block_type == 'question':
+        if used:
+            surf.fill((180, 140, 100))  # Used block color
+        else:
+            surf.fill(QUESTION_BLOCK_COLOR)
+            # Animated question mark
+            q_text = question_mark(int(h * 0.8))
+            q_rect = q_text.get_rect(center=surf.get_rect().center)
+            surf.blit(q_text, q_rect)
+    elif block_type == 'pipe':
+        # Draw a classic Mario pipe
+        pygame.draw.rect(surf, PIPE_GREEN, (0, 0, w, h))
+        pygame.draw.rect(surf, PIPE_DARK_GREEN, (0, 0, 5, h))
+        pygame.draw.rect(surf, PIPE_DARK_GREEN, (w-5, 0, 5, h))
+        pygame.draw.rect(surf, PIPE_DARK_GREEN, (0, 0, w, 5))
+    return surf
+
+class Platform(EntityView):
+    def __init__(self, x, y, w, h, block_type='ground', store=None):
+        surf = block_surface(block_type, (w, h))
+        super().__init__(KIND_PLATFORM, surf, surf.get_rect(topleft=(x, y)), LAYER_PLATFORM, store)
         self.block_type = block_type
-        self.surf = pygame.Surface((w, h))
-        self.rect = self.surf.get_rect(topleft=(x, y))
-        self.hit_animation = 0
-        self.original_y = y
-        self.was_hit = False
-        self.draw_block()
+        self.store.add_collider(self.eid, block_type)
+
+    @property
+    def hit_animation(self):
+        return self.store.bounce[self.eid]
+
+    @hit_animation.setter
+    def hit_animation(self, value):
+        self.store.bounce[self.eid] = value
+
+    @property
+    def original_y(self):
+        return self.store.rest_y[self.eid]
+
+    @property
+    def was_hit(self):
+        return self.store.was_hit[self.eid]
+
+    @was_hit.setter
+    def was_hit(self, value):
+        self.store.was_hit[self.eid] = value
 
     def draw_block(self):
-        if self.block_type == 'ground':
-            self.surf.fill(GROUND_COLOR)
-            # Add texture
-            for i in range(0, self.rect.width, 8):
-                if i + 4 < self.rect.width:
-                    pygame.draw.line(self.surf, (200, 120, 40), (i, 0), (i+4, 8), 2)
-        elif self.block_type == 'brick':
-            self.surf.fill(BRICK_COLOR)
-            w, h = self.rect.size
-            for i in range(0, int(w), 16):
-                pygame.draw.line(self.surf, BRICK_MORTAR_COLOR, (i, 0), (i, h), 2)
-            for i in range(0, int(h), 16):
-                pygame.draw.line(self.surf, BRICK_MORTAR_COLOR, (0, i), (w, i), 2)
-        elif self.block_type == 'question':
-            if self.was_hit:
-                self.surf.fill((180, 140, 100))  # Used block color
-            else:
-                self.surf.fill(QUESTION_BLOCK_COLOR)
-                # Animated question mark
-                q_font = pygame.font.Font(None, int(self.rect.h * 0.8))
-                q_text = q_font.render("?", True, BLACK)
-                q_rect = q_text.get_rect(center=self.surf.get_rect().center)
-                self.surf.blit(q_text, q_rect)
-        elif self.block_type == 'pipe':
-            # Draw a classic Mario pipe
-            pygame.draw.rect(self.surf, PIPE_GREEN, (0, 0, self.rect.width, self.rect.height))
-            pygame.draw.rect(self.surf, PIPE_DARK_GREEN, (0, 0, 5, self.rect.height))
-            pygame.draw.rect(self.surf, PIPE_DARK_GREEN, (self.rect.width-5, 0, 5, self.rect.height))
-            pygame.draw.rect(self.surf, PIPE_DARK_GREEN, (0, 0, self.rect.width, 5))
-            
+        """Show the look that goes with the block's state."""
+        self.surf = block_surface(self.block_type, self.rect.size, self.was_hit)
+
     def hit(self):
         if self.block_type == 'question' and not self.was_hit:
-            self.hit_animation = 20
+            self.hit_animation = BLOCK_BOUNCE_TICKS
             self.was_hit = True
-            
+            self.store.activate(self.eid, block_bounce_task)
+            metrics.count('blocks_hit')
+
     def update(self):
-        if self.hit_animation > 0:
-            # Bounce animation
-            offset = math.sin(self.hit_animation * 0.3) * 5
-            self.rect.y = int(self.original_y - offset)
-            self.hit_animation -= 1
-            if self.hit_animation == 0:
-                self.rect.y = self.original_y
-                self.draw_block()
+        self.update_active()
 
 # --- Enhanced Enemy Class ---
-class Enemy(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        super().__init__()
-        self.surf = pygame.Surface((32, 32), pygame.SRCALPHA)
-        self.normal_surf = pygame.Surface((32, 32), pygame.SRCALPHA)
-        self.squished_surf = pygame.Surface((32, 32), pygame.SRCALPHA)
-        self.rect = self.surf.get_rect(topleft=(x, y))
-        self.pos = pygame.math.Vector2(float(x), float(y))
-        self.vel = pygame.math.Vector2(ENEMY_SPEED, 0)
-        self.patrol_range = (x - 100, x + 100)
-        self.squish_timer = 0
-        self.alive = True
-        self.walk_frame = 0
-        self.pre_draw_enemy()
-        self.update_sprite()
-
-    def pre_draw_enemy(self):
+class Enemy(EntityView):
+    # Sprite frames are identical for every goomba, so they are drawn once
+    # and shared: walk_frames[walk_frame] while alive, squished_surf after.
+    normal_surf = None
+    squished_surf = None
+    walk_frames = ()
+
+    def __init__(self, x, y, store=None):
+        if Enemy.normal_surf is None:
+            Enemy.pre_draw_enemy()
+        super().__init__(KIND_ENEMY, Enemy.walk_frames[0], pygame.Rect(x, y, 32, 32),
+                         LAYER_ENEMY, store)
+        self.store.add_ai(self.eid, ENEMY_SPEED, (x - 100, x + 100))
+
+    @staticmethod
+    def pre_draw_enemy():
         # Pre-draw normal enemy
-        self.normal_surf.fill((0, 0, 0, 0))
+        normal_surf = pygame.Surface((32, 32), pygame.SRCALPHA)
         # Body
-        pygame.draw.ellipse(self.normal_surf, ENEMY_BODY_COLOR, (0, 4, 32, 28))
+        pygame.draw.ellipse(normal_surf, ENEMY_BODY_COLOR, (0, 4, 32, 28))
         # Eyes
-        pygame.draw.rect(self.normal_surf, BLACK, (8, 12, 5, 8))
-        pygame.draw.rect(self.normal_surf, BLACK, (19, 12, 5, 8))
+        pygame.draw.rect(normal_surf, BLACK, (8, 12, 5, 8))
+        pygame.draw.rect(normal_surf, BLACK, (19, 12, 5, 8))
         # Angry eyebrows
-        pygame.draw.line(self.normal_surf, BLACK, (8, 10), (13, 8), 2)
-        pygame.draw.line(self.normal_surf, BLACK, (19, 8), (24, 10), 2)
-        
+        pygame.draw.line(normal_surf, BLACK, (8, 10), (13, 8), 2)
+        pygame.draw.line(normal_surf, BLACK, (19, 8), (24, 10), 2)
+
         # Pre-draw squished enemy
-        self.squished_surf.fill((0, 0, 0, 0))
-        pygame.draw.ellipse(self.squished_surf, ENEMY_BODY_COLOR, (0, 20, 32, 12))
+        squished_surf = pygame.Surface((32, 32), pygame.SRCALPHA)
+        pygame.draw.ellipse(squished_surf, ENEMY_BODY_COLOR, (0, 20, 32, 12))
 
-    def update_sprite(self):
-        self.surf.fill((0, 0, 0, 0))
-        if self.alive:
-            self.surf.blit(self.normal_surf, (0, 0))
-            # Draw animated feet
-            offset = self.walk_frame * 4
-            pygame.draw.rect(self.surf, ENEMY_FEET_COLOR, (2 + offset, 28, 12, 4))
-            pygame.draw.rect(self.surf, ENEMY_FEET_COLOR, (18 - offset, 28, 12, 4))
+        # Walk cycle: body plus feet in each position
+        walk_frames = []
+        for walk_frame in (0, 1):
+            frame = pygame.Surface((32, 32), pygame.SRCALPHA)
+            frame.blit(normal_surf, (0, 0))
+            offset = walk_frame * 4
+            pygame.draw.rect(frame, ENEMY_FEET_COLOR, (2 + offset, 28, 12, 4))
+            pygame.draw.rect(frame, ENEMY_FEET_COLOR, (18 - offset, 28, 12, 4))
+            walk_frames.append(frame)
+
+        Enemy.normal_surf = prepare_surface(normal_surf)
+        Enemy.squished_surf = prepare_surface(squished_surf)
+        Enemy.walk_frames = tuple(prepare_surface(frame) for frame in walk_frames)
+
+    @property
+    def alive(self):
+        return self.store.alive[self.eid]
+
+    @alive.setter
+    def alive(self, value):
+        self.store.alive[self.eid] = value
+        if value:
+            self.store.deactivate(self.eid)
         else:
-            self.surf.blit(self.squished_surf, (0, 0))
+            self.store.activate(self.eid, squish_task)
+
+    @property
+    def patrol_range(self):
+        return (self.store.patrol_min[self.eid], self.store.patrol_max[self.eid])
+
+    @property
+    def squish_timer(self):
+        return self.store.squish_timer[self.eid]
 
-    def update(self, platforms):
+    @property
+    def walk_frame(self):
+        return self.store.anim_frame[self.eid]
+
+    def update_sprite(self):
         if self.alive:
-            self.pos.x += self.vel.x
-            if self.pos.x < self.patrol_range[0] or self.pos.x > self.patrol_range[1]:
-                self.vel.x *= -1
-            self.rect.x = int(self.pos.x)
-            self.rect.y = int(self.pos.y)
-            # Update walk animation every 10 frames
-            if pygame.time.get_ticks() % 200 < 100:
-                self.walk_frame = 0
-            else:
-                self.walk_frame = 1
-            self.update_sprite()
+            self.surf = Enemy.walk_frames[self.walk_frame]
         else:
-            self.squish_timer += 1
-            if self.squish_timer > 30:
-                self.kill()
+            self.surf = Enemy.squished_surf
+
+    def update(self, platforms=None):
+        enemy_ai_system(self.store, (self.eid,))
+        self.update_active()
+
+# --- Level ---
+def diff_entries(built, entries):
+    """Match level ``entries`` by value against the (entry, eid) pairs already built.
+
+    Returns the ids that no entry matched, and (entry, eid) pairs in the
+    order of ``entries`` with eid None where nothing is built yet.
+    """
+    unmatched = {}
+    for entry, eid in built:
+        unmatched.setdefault(entry, deque()).append(eid)
+    pairs = []
+    for entry in entries:
+        eids = unmatched.get(entry)
+        pairs.append((entry, eids.popleft() if eids else None))
+    removed = sorted(eid for eids in unmatched.values() for eid in eids)
+    return removed, pairs
+
+class Level:
+    """One level of LEVEL_DATA built into its own entity store.
+
+    The sprite groups are kept for code that still works with sprites;
+    per-frame work goes through the store's systems.
+    """
+
+    def __init__(self, number, store=None):
+        self.number = number
+        self.data = LEVEL_DATA[number]
+        self.store = EntityStore() if store is None else store
+        self.all_sprites = pygame.sprite.Group()
+        self.platforms = pygame.sprite.Group()
+        self.enemies = pygame.sprite.Group()
+
+        # Create player
+        self.player = Player(self.store)
+        start_x, start_y = self.data['start_pos']
+        self.player.rect.topleft = (start_x, start_y)
+        self.player.pos = (start_x, start_y)
+        self.all_sprites.add(self.player)
+
+        # Create platforms and enemies, remembering which entry built which
+        # entity so an edited level can be applied in place
+        self.platform_ids = [(p_data, self._add_platform(p_data)) for p_data in self.data['platforms']]
+        self.enemy_ids = [(e_data, self._add_enemy(e_data)) for e_data in self.data['enemies']]
+        self._set_width()
+
+        # Bake blocks that never change; question blocks stay sprites
+        self.store.static_layer = StaticLayer(self.store)
+        for p in self.platforms:
+            if p.block_type != 'question':
+                self.store.static_layer.bake(p.eid)
+        # Collide against merged shapes rather than block by block
+        self.store.compile_colliders()
+
+        self.initial_state = self.capture()
+
+    def _set_width(self):
+        self.width = max([SCREEN_WIDTH] + [x + w for x, _, w, _, _ in self.data['platforms']])
+        self.player.world_width = self.width if self.width > SCREEN_WIDTH else None
+
+    def camera_x(self):
+        """Left edge of the view: centred on the player, but never past the level's ends."""
+        if self.width <= SCREEN_WIDTH:
+            return 0
+        return max(0, min(self.width - SCREEN_WIDTH, self.player.rect.centerx - SCREEN_WIDTH // 2))
+
+    def _add_platform(self, p_data):
+        p = Platform(*p_data, store=self.store)
+        self.platforms.add(p)
+        self.all_sprites.add(p)
+        return p.eid
+
+    def _add_enemy(self, e_data):
+        e = Enemy(*e_data, store=self.store)
+        self.enemies.add(e)
+        self.all_sprites.add(e)
+        return e.eid
+
+    def apply(self, data):
+        """Change the level to ``data`` in place, touching only what differs.
+
+        Blocks and enemies are matched to the old entries by value; those
+        that are gone are destroyed and new ones created, and only their
+        static layer chunks and collision shapes are redone. The level is
+        reset to its (new) start, except that the player stays where it is.
+        Returns (blocks added, blocks removed, enemies added, enemies removed).
+        """
+        store = self.store
+        player = self.player
+        playing = (player.pos, player.vel, tuple(player.rect), player.get_state())
+        self.reset()
+
+        dirty = []
+        removed, self.platform_ids = diff_entries(self.platform_ids, data['platforms'])
+        for eid in removed:
+            if store.baked[eid]:
+                store.static_layer.unbake(eid)
+            dirty.append(store.collider_bounds[eid])
+            store.view[eid].kill()
+        added = [index for index, (_, eid) in enumerate(self.platform_ids) if eid is None]
+        for index in added:
+            p_data = self.platform_ids[index][0]
+            eid = self._add_platform(p_data)
+            if store.block_type[eid] != 'question':
+                store.static_layer.bake(eid)
+            dirty.append(store.collider_bounds[eid])
+            self.platform_ids[index] = (p_data, eid)
+        store.recompile_colliders(dirty)
+
+        gone, self.enemy_ids = diff_entries(self.enemy_ids, data['enemies'])
+        for eid in gone:
+            store.view[eid].kill()
+        spawned = [index for index, (_, eid) in enumerate(self.enemy_ids) if eid is None]
+        for index in spawned:
+            e_data = self.enemy_ids[index][0]
+            self.enemy_ids[index] = (e_data, self._add_enemy(e_data))
+
+        self.data = data
+        self._set_width()
+        player.pos = data['start_pos']
+        player.rect.topleft = data['start_pos']
+        self.initial_state = self.capture()
+        player.pos, player.vel, player.rect, state = playing
+        player.set_state(state)
+        return len(added), len(removed), len(spawned), len(gone)
+
+    def _fill_groups(self, revived):
+        """Put ``revived`` sprites back so their groups keep creation order.
+
+        Only the groups they belong to are rebuilt; nothing iterates
+        all_sprites, so they simply rejoin it.
+        """
+        store = self.store
+        live, kinds, views = store.live, store.kind, store.view
+        revived_kinds = {kinds[eid] for eid in revived}
+        for kind, group, entries in ((KIND_PLATFORM, self.platforms, self.platform_ids),
+                                     (KIND_ENEMY, self.enemies, self.enemy_ids)):
+            if kind in revived_kinds:
+                group.empty()
+                group.add(*[views[eid] for eid in sorted(eid for _, eid in entries if live[eid])])
+        self.all_sprites.add(*[views[eid] for eid in revived])
+
+    def capture(self):
+        """Everything needed to put the level back exactly as it is now."""
+        return (self.store.snapshot(), self.player.get_state())
+
+    def restore(self, state):
+        store_state, player_state = state
+        store = self.store
+        # A block's look is its shared surface, which the surf column restores
+        revived = store.restore(store_state)
+        if revived:
+            self._fill_groups(revived)
+        self.player.set_state(player_state)
+
+    def reset(self):
+        """Return to the freshly built level without rebuilding anything."""
+        self.restore(self.initial_state)
+
+# --- Level Loader ---
+PREFETCH_DISTANCE = 200  # Start building the next level this close to the exit
+
+class LevelLoader:
+    """Builds the next level on a worker thread while the current one finishes.
+
+    ``prefetch`` starts the build; ``take`` waits for it and hands over the
+    finished Level in one step, building synchronously if nothing was
+    prefetched for that number.
+    """
+
+    def __init__(self):
+        self._number = None
+        self._thread = None
+        self._result = None
+        self._error = None
+
+    def prefetch(self, number):
+        if number == self._number or number not in LEVEL_DATA:
+            return
+        self._join()
+        self._number = number
+        self._result = self._error = None
+        self._thread = threading.Thread(target=self._build, args=(number,),
+                                        name=f"level-loader-{number}", daemon=True)
+        self._thread.start()
+
+    def _build(self, number):
+        try:
+            self._result = Level(number)
+        except Exception as error:
+            self._error = error
+
+    def _join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def take(self, number):
+        metrics.count('level_loads')
+        if number != self._number:
+            metrics.count('prefetch_misses')
+            return Level(number)
+        metrics.count('prefetch_hits')
+        self._join()
+        level, error = self._result, self._error
+        self._number = self._result = self._error = None
+        if error is not None:
+            raise error
+        return level
 
 # --- Optimized Screen Transition Effect ---
-def transition_effect(screen, direction='out'):
-    steps = 15  # Reduced from 20 for smoother animation
-    for i in range(steps):
-        if direction == 'out':
-            radius = i * (SCREEN_WIDTH // steps)
-        else:
-            radius = SCREEN_WIDTH - (i * (SCREEN_WIDTH // steps))
-        
-        screen.fill(BLACK)
-        if radius > 0:
-            pygame.draw.circle(screen, BACKGROUND_COLOR, 
-                             (SCREEN_WIDTH//2, SCREEN_HEIGHT//2), radius)
-        
-        pygame.display.flip()
-        clock.tick(60)
+TRANSITION_STEPS = 15  # Reduced from 20 for smoother animation
 
-# --- Game Loop Function ---
-def game_loop():
-    current_level = 1
-    game_complete = False
+def draw_transition(screen, direction, i):
+    steps = TRANSITION_STEPS
+    if direction == 'out':
+        radius = i * (SCREEN_WIDTH // steps)
+    else:
+        radius = SCREEN_WIDTH - (i * (SCREEN_WIDTH // steps))
     
-    while not game_complete:
-        # Initialize level
-        all_sprites = pygame.sprite.Group()
-        platforms = pygame.sprite.Group()
-        enemies = pygame.sprite.Group()
-        
-        level_data = LEVEL_DATA[current_level]
-        
-        # Create player
-        player = Player()
-        start_x, start_y = level_data['start_pos']
-        player.rect.topleft = (start_x, start_y)
-        player.pos = pygame.math.Vector2(float(start_x), float(start_y))
-        all_sprites.add(player)
-        
-        # Create platforms
-        for p_data in level_data['platforms']:
-            p = Platform(*p_data)
-            platforms.add(p)
-            all_sprites.add(p)
-            
-        # Create enemies
-        for e_data in level_data['enemies']:
-            e = Enemy(*e_data)
-            enemies.add(e)
-            all_sprites.add(e)
-        
-        # Transition in
-        transition_effect(screen, 'in')
-        
-        level_complete = False
-        particles.clear()
-        
-        while not level_complete:
-            dt = clock.tick(FPS) / 1000.0
-            
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    return
-                if event.type == pygame.KEYDOWN:
-                    if event.key in [pygame.K_UP, pygame.K_SPACE, pygame.K_w]:
-                        player.jump()
-                if event.type == pygame.KEYUP:
-                    if event.key in [pygame.K_UP, pygame.K_SPACE, pygame.K_w]:
-                        player.jump_held = False
-
-            # Update
-            player.update(platforms)
-            enemies.update(platforms)
-            
-            # Update platforms with animations
-            for platform in platforms:
-                if hasattr(platform, 'update'):
-                    platform.update()
-            
-            # Update particles
-            for particle in particles[:]:
-                particle.update()
-                if particle.life <= 0:
-                    particles.remove(particle)
-
-            # Player-Enemy Collision
-            enemy_hit = pygame.sprite.spritecollideany(player, enemies)
-            if enemy_hit and enemy_hit.alive:
-                # More precise collision detection
-                if (player.vel.y > 1 and 
-                    player.rect.bottom > enemy_hit.rect.top and
-                    player.rect.bottom < enemy_hit.rect.centery + 10 and
-                    player.rect.centerx > enemy_hit.rect.left and
-                    player.rect.centerx < enemy_hit.rect.right):
-                    # Successful stomp
-                    enemy_hit.alive = False
-                    enemy_hit.update_sprite()
-                    player.vel.y = PLAYER_JUMP_STRENGTH / 2
-                    # Stomp particles
+    screen.fill(BLACK)
+    if radius > 0:
+        pygame.draw.circle(screen, BACKGROUND_COLOR, 
+                         (screen.get_width()//2, screen.get_height()//2),
+                         int(radius * surface_scale(screen)[0]))
+
+def draw_complete(screen):
+    screen.fill(BACKGROUND_COLOR)
+    complete_text = render_text(big_font, "GAME COMPLETE!", TEXT_COLOR)
+    complete_rect = complete_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
+    blit_logical(screen, complete_text, complete_rect)
+    
+    thanks_text = render_text(font, "Thanks for playing!", TEXT_COLOR)
+    thanks_rect = thanks_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
+    blit_logical(screen, thanks_text, thanks_rect)
+
+def update_particles(particles):
+    for particle in particles:
+        particle.update()
+    particles[:] = [particle for particle in particles if particle.life > 0]
+
+# --- Game State ---
+MODE_PLAY = 'play'
+MODE_PIPE = 'pipe'
+MODE_TRANSITION_OUT = 'out'
+MODE_TRANSITION_IN = 'in'
+MODE_COMPLETE = 'complete'
+
+PIPE_TICKS = 30
+PIPE_SPEED = 2  # px/tick
+COMPLETE_TICKS = 3 * REFERENCE_HZ
+JUMP_KEYS = (pygame.K_UP, pygame.K_SPACE, pygame.K_w)
+PAUSE_KEYS = (pygame.K_p, pygame.K_PAUSE)
+# Keys that move the player, i.e. every key held_buttons reads; only these
+# are timed by input_latency
+PLAY_KEYS = frozenset((pygame.K_LEFT, pygame.K_a, pygame.K_RIGHT, pygame.K_d,
+                       pygame.K_DOWN, pygame.K_s, pygame.K_LSHIFT, pygame.K_z) + JUMP_KEYS)
+IDLE_REDRAW_MS = 250  # Redraw interval while paused or unfocused
+
+# Everything the renderer needs for one frame. Positions are plain tuples,
+# the lists are never touched again and no entity surface is drawn on once
+# made (a block or sprite changes look by switching to another shared
+# surface), so a snapshot can be drawn on one thread while the next frames
+# are simulated on another.
+RenderSnapshot = namedtuple('RenderSnapshot', 'frame mode timer level entities particles hint paused')
+
+def same_picture(a, b):
+    """True if two snapshots would draw the same image."""
+    return a is not None and b is not None and a[1:] == b[1:]
+
+class Game:
+    """The whole game as a state machine that advances one frame per ``step``.
+
+    Pipe entry, transitions and the completion screen are modes rather than
+    blocking loops, so nothing here waits or draws: the caller decides when
+    to step and renders ``snapshot()`` however it likes.
+
+    ``level`` is an already built Level of ``start_level`` to play on.
+    Games someone is playing pass ``prefetch=True`` to build the next level
+    on a loader thread as the player nears the exit; headless ones build
+    each level only when it is reached. Particles belong to the game, so
+    games running side by side don't share them; ``particles=False`` turns
+    them off for games nobody watches.
+    """
+
+    def __init__(self, start_level=1, loader=None, level=None, prefetch=False, particles=True):
+        self.loader = LevelLoader() if loader is None else loader
+        self.prefetch = prefetch
+        self.number = start_level
+        self.particles = [] if particles else None  # None: no particles are made
+        self._use(self.loader.take(start_level) if level is None else level)
+        self.frame = 0
+        self.done = False
+        self.paused = False
+        self.focused = True
+        self.keys = None  # None plays from keyboard events; see HeldKeys
+        self.held = HeldKeys()  # Keys down, as of the events handled so far
+        self.pipe_y = 0
+        self._enter(MODE_TRANSITION_IN)
+
+    def _enter(self, mode, then=None):
+        self.mode = mode
+        self.timer = 0
+        self._then = then
+
+    @property
+    def idle(self):
+        """Paused by the player or sitting in an unfocused window."""
+        return self.paused or not self.focused
+
+    def handle_event(self, event, stamp=None):
+        """Apply one input event; ``stamp`` is when it was taken off the queue."""
+        if event.type == pygame.KEYDOWN:
+            self.held.held.add(event.key)
+        elif event.type == pygame.KEYUP:
+            self.held.held.discard(event.key)
+        if event.type == pygame.WINDOWFOCUSLOST or event.type == pygame.WINDOWMINIMIZED:
+            self.focused = False
+            self.held.held.clear()  # Releases won't reach an unfocused window
+            input_latency.clear()  # Or time spent away would count as latency
+        elif event.type == pygame.WINDOWFOCUSGAINED or event.type == pygame.WINDOWRESTORED:
+            self.focused = True
+        elif event.type == pygame.KEYDOWN and event.key in PAUSE_KEYS:
+            self.paused = not self.paused
+            if self.paused:
+                input_latency.clear()
+        elif event.type == pygame.KEYDOWN and event.key in JUMP_KEYS:
+            self.focused = True  # Input means someone is playing
+            if self.mode == MODE_PLAY and not self.paused:
+                self.level.player.jump()
+        elif event.type == pygame.KEYUP and event.key in JUMP_KEYS:
+            self.level.player.jump_held = False
+        # Sampled last, once the event has had its say on pausing and focus
+        if (stamp is not None and event.type == pygame.KEYDOWN and event.key in PLAY_KEYS
+                and self.mode == MODE_PLAY and not self.idle):
+            input_latency.sampled(self.frame + 1, stamp)
+
+    def step(self):
+        if self.idle:
+            return
+        self.frame += 1
+        mode = self.mode
+        if mode == MODE_PLAY:
+            self._play()
+        elif mode == MODE_PIPE:
+            if self.timer >= PIPE_TICKS:
+                self._next_level()
+            else:
+                self._pipe()
+        elif mode == MODE_TRANSITION_OUT or mode == MODE_TRANSITION_IN:
+            self.timer += SIM_TICKS
+            if self.timer >= TRANSITION_STEPS:
+                if mode == MODE_TRANSITION_OUT:
+                    self._then()
+                    self._enter(MODE_TRANSITION_IN)
+                else:
+                    self._enter(MODE_PLAY)
+                    self._play()
+        elif mode == MODE_COMPLETE:
+            self.timer += SIM_TICKS
+            if self.timer >= COMPLETE_TICKS:
+                self.done = True
+
+    def read_keys(self):
+        """Held keys for this frame: from keyboard events, or ``self.keys`` if set."""
+        if self.keys is not None:
+            return self.keys
+        return self.held
+
+    def _play(self):
+        level = self.level
+        store, player = level.store, level.player
+        keys = self.read_keys()
+        right = player.rect.right
+        player.update(keys=keys)
+        update_systems(store)
+        if self.particles is not None:
+            update_particles(self.particles)
+
+        # Player-Enemy Collision
+        hit_id = store.first_walker_hit(player.rect)
+        enemy_hit = store.view[hit_id] if hit_id is not None else None
+        if enemy_hit and enemy_hit.alive:
+            # More precise collision detection
+            if (player.vel.y > 1 and 
+                player.rect.bottom > enemy_hit.rect.top and
+                player.rect.bottom < enemy_hit.rect.centery + 10 and
+                player.rect.centerx > enemy_hit.rect.left and
+                player.rect.centerx < enemy_hit.rect.right):
+                # Successful stomp
+                enemy_hit.alive = False
+                enemy_hit.update_sprite()
+                store.vy[player.eid] = PLAYER_JUMP_STRENGTH / 2
+                # Stomp particles
+                if self.particles is not None:
                     for i in range(6):
                         add_particle(
+                            self.particles,
                             enemy_hit.rect.centerx,
                             enemy_hit.rect.centery,
                             random.uniform(-3, 3),
                             random.uniform(-4, -1),
                             ENEMY_BODY_COLOR
                         )
+            else:
+                # Player dies - restart level in place
+                metrics.count('deaths')
+                self._enter(MODE_TRANSITION_OUT, self._respawn)
+                return
+
+        # Check for level completion (reach exit pipe)
+        if level.data['exit_pos']:
+            exit_x, exit_y = level.data['exit_pos']
+            if self.prefetch and abs(player.rect.centerx - exit_x) < PREFETCH_DISTANCE:
+                self.loader.prefetch(self.number + 1)
+            if (abs(player.rect.centerx - exit_x) < 30 and 
+                abs(player.rect.centery - exit_y) < 50):
+                if keys[pygame.K_DOWN] or keys[pygame.K_s]:
+                    # Enter pipe animation
+                    self._enter(MODE_PIPE)
+                    self.pipe_y = player.rect.y
+                    self._pipe()
+        elif self.number == LAST_LEVEL:
+            # Last level - check if reached the right edge, walking there
+            # rather than wrapping in from the left one
+            finish = level.width - 10
+            if right < finish <= player.rect.right and not player.wrapped:
+                self._enter(MODE_COMPLETE)
+
+    def _pipe(self):
+        self.timer += SIM_TICKS
+        self.level.player.rect.y = self.pipe_y + int(PIPE_SPEED * self.timer)
+
+    def _use(self, level):
+        self.level = level
+        level.player.particles = self.particles
+        self._clear_particles()
+
+    def _clear_particles(self):
+        if self.particles is not None:
+            self.particles.clear()
+
+    def _respawn(self):
+        self.level.reset()
+        self._clear_particles()
+
+    def resume(self):
+        """Play on from the level as it is now, e.g. after ``Level.restore``."""
+        self._clear_particles()
+        self.done = False
+        self._enter(MODE_PLAY)
+
+    def restart_level(self):
+        """Reset the current level and play on at once, skipping the transitions."""
+        self.level.reset()
+        self.resume()
+
+    def load_level(self, number):
+        """Jump straight to level ``number`` and start playing it."""
+        if number not in LEVEL_DATA:
+            raise ValueError(f"no level {number}")
+        self.number = number
+        self._use(self.loader.take(number))
+        self.resume()
+
+    def _load_next(self):
+        self._use(self.loader.take(self.number))
+
+    def _next_level(self):
+        self.number += 1
+        if self.number > LAST_LEVEL:
+            self._enter(MODE_COMPLETE)
+        else:
+            self._enter(MODE_TRANSITION_OUT, self._load_next)
+
+    def hint_pos(self):
+        """Where to show the pipe entry hint, or None."""
+        exit_pos = self.level.data['exit_pos']
+        if exit_pos:
+            exit_x, exit_y = exit_pos
+            rect = self.level.player.rect
+            if abs(rect.centerx - exit_x) < 40 and abs(rect.centery - exit_y) < 60:
+                return (exit_x, exit_y - 80)
+        return None
+
+    def snapshot(self):
+        if self.mode == MODE_PLAY or self.mode == MODE_PIPE:
+            camera = self.level.camera_x()
+            hint = self.hint_pos()
+            if camera:
+                viewport = VIEWPORT.move(camera, 0)
+                hint = hint and (hint[0] - camera, hint[1])
+            else:
+                viewport = VIEWPORT
+            return RenderSnapshot(self.frame, self.mode, self.timer, self.number,
+                                  entity_items(self.level.store, viewport), particle_states(self.particles or (), camera),
+                                  hint, self.idle)
+        return RenderSnapshot(self.frame, self.mode, self.timer, self.number, (), (), None, self.idle)
+
+def draw_snapshot(screen, snapshot):
+    mode = snapshot.mode
+    if mode == MODE_PLAY or mode == MODE_PIPE:
+        draw_world(screen, snapshot.entities, snapshot.particles, snapshot.level, snapshot.hint)
+    elif mode == MODE_TRANSITION_OUT or mode == MODE_TRANSITION_IN:
+        draw_transition(screen, mode, snapshot.timer)
+    else:
+        draw_complete(screen)
+    if snapshot.paused:
+        paused_text = render_text(big_font, "PAUSED", TEXT_COLOR)
+        blit_logical(screen, paused_text, paused_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2)))
+
+def wait_events(timeout):
+    """Block until an event arrives or ``timeout`` ms pass; return all pending events.
+
+    Used instead of polling while idle so the process sleeps in the OS.
+    """
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
+
+def timed_step(game):
+    started = time.perf_counter()
+    game.step()
+    metrics.time('simulation', time.perf_counter() - started)
+
+def render_frame(snapshot):
+    """Draw ``snapshot`` to the screen and present it."""
+    started = time.perf_counter()
+    draw_snapshot(screen, snapshot)
+    metrics.time('render', time.perf_counter() - started)
+    present()
+    input_latency.presented(snapshot.frame, time.perf_counter())
+
+# --- Threaded Mode ---
+class SnapshotBuffer:
+    """Double buffer of render snapshots between the simulation and render threads.
+
+    The simulation writes the back slot and flips; the renderer always reads
+    the front slot, i.e. the newest complete frame.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = [None, None]
+        self._front = 0
+
+    def publish(self, snapshot):
+        back = self._front ^ 1
+        self._slots[back] = snapshot
+        with self._lock:
+            self._front = back
+
+    def latest(self):
+        with self._lock:
+            return self._slots[self._front]
+
+def simulation_thread(game, snapshots, events, stop, session_log=None):
+    """Step ``game`` at SIM_HZ on its own thread, publishing a snapshot per step."""
+    # The render thread's pacer feeds the FPS counter and frame metrics
+    pacer = FramePacer(SIM_HZ, 'sleep', measure=False)
+    while not stop.is_set() and not game.done:
+        if game.idle:
+            # Nothing to simulate; sleep until the next event or redraw
+            try:
+                game.handle_event(*events.get(timeout=IDLE_REDRAW_MS / 1000))
+            except queue.Empty:
+                pass
+            snapshots.publish(game.snapshot())
+            pacer.reset()
+            continue
+        pacer.wait()
+        while True:
+            try:
+                game.handle_event(*events.get_nowait())
+            except queue.Empty:
+                break
+        timed_step(game)
+        if session_log is not None:
+            session_log.record(game, held_buttons(game.read_keys()))
+        snapshots.publish(game.snapshot())
+
+def threaded_game_loop(game, profiler=None, session_log=None):
+    """Simulate on a worker thread and render the newest snapshot here.
+
+    pygame blits release the GIL, so drawing one frame overlaps simulating
+    the next on a multi-core machine.
+    """
+    snapshots = SnapshotBuffer()
+    events = queue.Queue()
+    stop = threading.Event()
+    snapshots.publish(game.snapshot())
+    worker = threading.Thread(target=simulation_thread, args=(game, snapshots, events, stop, session_log),
+                              name="simulation", daemon=True)
+    worker.start()
+    if profiler is not None:
+        profiler.watch(worker)
+    drawn = None
+    pacer = FramePacer(FPS)
+    try:
+        while worker.is_alive():
+            if drawn is not None and drawn.paused:
+                pending = wait_events(IDLE_REDRAW_MS)
+                metrics.frame_gap()
+                pacer.reset()
+            else:
+                metrics.frame(pacer.wait())
+                pending = pygame.event.get()
+            stamp = time.perf_counter()
+            for event in pending:
+                if event.type == pygame.QUIT:
+                    return
+                if event.type == pygame.WINDOWEXPOSED:
+                    drawn = None
+                if event.type == pygame.KEYDOWN and event.key == PROFILE_KEY and profiler is not None:
+                    profiler.toggle()
+                events.put((event, stamp))
+            snapshot = snapshots.latest()
+            if not same_picture(snapshot, drawn):
+                render_frame(snapshot)
+            drawn = snapshot
+    finally:
+        stop.set()
+        worker.join()
+
+# --- Async Mode ---
+async def async_game_loop(game=None):
+    """Run the game as a coroutine, one frame per iteration.
+
+    Between frames it awaits the next frame deadline instead of blocking in
+    ``clock.tick``, so other tasks on the same event loop (telemetry,
+    remote configuration, ...) run in the slack. Returns when the game is
+    complete or the window is closed.
+    """
+    if game is None:
+        game = Game(prefetch=True)
+    pacer = FramePacer(SIM_HZ, 'sleep')
+    
+    drawn = game.snapshot()
+    render_frame(drawn)
+    while not game.done:
+        if game.idle:
+            # Can't block in event.wait without stalling the loop, so poll slowly
+            await asyncio.sleep(IDLE_REDRAW_MS / 1000)
+            pacer.reset()
+            metrics.frame_gap()
+        else:
+            # Even with no time left, sleeping 0 lets other tasks run
+            await asyncio.sleep(max(0.0, pacer.advance()))
+            metrics.frame(pacer.started())
+        
+        stamp = time.perf_counter()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return
+            if event.type == pygame.WINDOWEXPOSED:
+                drawn = None
+            game.handle_event(event, stamp)
+
+        timed_step(game)
+        snapshot = game.snapshot()
+        if not same_picture(snapshot, drawn):
+            render_frame(snapshot)
+        drawn = snapshot
+
+async def async_wait_for_start():
+    """Async counterpart of ``wait_for_start``, polling at the idle rate."""
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+            if event.type == pygame.KEYDOWN:
+                return True
+        await asyncio.sleep(IDLE_REDRAW_MS / 1000)
+
+async def async_main(start_screen=True, start_level=1):
+    """Entry point for embedding the game in an existing asyncio application."""
+    if start_screen:
+        draw_start_screen(screen)
+        present()
+        if not await async_wait_for_start():
+            return
+    await async_game_loop(Game(start_level, prefetch=True))
+
+# --- Automation Server ---
+# Control protocol. Every message, in either direction, is a little-endian
+# uint32 length followed by that many bytes. Requests start with an opcode
+# byte, responses with a status byte; the rest is the payload.
+PROTOCOL_VERSION = 2  # 2: 32-bit enemy and platform coordinates and counts
+OP_INPUT = 1    # uint8 button mask -> empty
+OP_STEP = 2     # uint32 frames -> uint32 frame counter
+OP_QUERY = 3    # empty -> game state, see ControlSession.encode_state
+OP_LOAD = 4     # uint16 level -> empty
+OP_FRAME = 5    # empty -> uint16 width, uint16 height, RGB bytes
+OP_QUIT = 6     # empty -> empty, then the server exits
+OP_VERSION = 7  # empty -> uint16 PROTOCOL_VERSION (version 1 servers answer unknown opcode)
+
+STATUS_OK = 0
+STATUS_ERROR = 1  # Payload is a UTF-8 message
+
+BUTTON_LEFT = 1
+BUTTON_RIGHT = 2
+BUTTON_DOWN = 4
+BUTTON_RUN = 8
+BUTTON_JUMP = 16
+BUTTON_KEYS = ((BUTTON_LEFT, pygame.K_LEFT), (BUTTON_RIGHT, pygame.K_RIGHT),
+               (BUTTON_DOWN, pygame.K_DOWN), (BUTTON_RUN, pygame.K_LSHIFT))
+
+def apply_buttons(game, previous, buttons):
+    """Hold the BUTTON_* mask ``buttons`` on ``game``; ``previous`` is the last mask applied."""
+    if game.keys is None:
+        game.keys = HeldKeys()
+    game.keys.held = {key for bit, key in BUTTON_KEYS if buttons & bit}
+    # Jump is edge-triggered in the game, so feed it as key events
+    pressed = buttons & ~previous
+    released = previous & ~buttons
+    if pressed & BUTTON_JUMP:
+        game.handle_event(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE))
+    if released & BUTTON_JUMP:
+        game.handle_event(pygame.event.Event(pygame.KEYUP, key=pygame.K_SPACE))
+
+def held_buttons(keys):
+    """The BUTTON_* mask for held ``keys``, counting every key the game accepts for each."""
+    buttons = 0
+    if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+        buttons |= BUTTON_LEFT
+    if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+        buttons |= BUTTON_RIGHT
+    if keys[pygame.K_DOWN] or keys[pygame.K_s]:
+        buttons |= BUTTON_DOWN
+    if keys[pygame.K_LSHIFT] or keys[pygame.K_z]:
+        buttons |= BUTTON_RUN
+    if any(keys[key] for key in JUMP_KEYS):
+        buttons |= BUTTON_JUMP
+    return buttons
+
+MODES = (MODE_PLAY, MODE_PIPE, MODE_TRANSITION_OUT, MODE_TRANSITION_IN, MODE_COMPLETE)
+BLOCK_TYPES = ('ground', 'brick', 'question', 'pipe')
+
+_LENGTH = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_FRAME_SIZE = struct.Struct('<HH')
+_STATE = struct.Struct('<IBBB')       # frame, level, mode index, flags (1 paused, 2 done)
+_PLAYER = struct.Struct('<ffffB')     # x, y, vx, vy, grounded
+_ENEMY = struct.Struct('<iiB')        # x, y, alive
+_PLATFORM = struct.Struct('<iiiiBB')  # x, y, w, h, block type index, was_hit
+
+class ControlSession:
+    """Serves the control protocol to one client over a pair of binary streams.
+
+    The game only advances when the client asks it to, so a session is fully
+    deterministic apart from ``random`` (stomp and jump particles).
+    """
+
+    def __init__(self, game, reader, writer):
+        self.game = game
+        self.reader = reader
+        self.writer = writer
+        self.buttons = 0
+        game.keys = HeldKeys()
+        self.handlers = {
+            OP_INPUT: self.do_input,
+            OP_STEP: self.do_step,
+            OP_QUERY: self.do_query,
+            OP_LOAD: self.do_load,
+            OP_FRAME: self.do_frame,
+            OP_VERSION: self.do_version,
+        }
+
+    def _read(self, size):
+        data = self.reader.read(size)
+        if len(data) < size:
+            raise EOFError
+        return data
+
+    def _send(self, status, payload=b''):
+        self.writer.write(_LENGTH.pack(len(payload) + 1) + bytes((status,)) + payload)
+        self.writer.flush()
+
+    def serve(self):
+        """Answer requests until the client disconnects; True if it sent OP_QUIT."""
+        while True:
+            try:
+                (length,) = _LENGTH.unpack(self._read(_LENGTH.size))
+                message = self._read(length)
+            except EOFError:
+                return False
+            pygame.event.pump()  # Keep the window responsive
+            if not message:
+                self._send(STATUS_ERROR, b"empty request")
+                continue
+            opcode, payload = message[0], message[1:]
+            if opcode == OP_QUIT:
+                self._send(STATUS_OK)
+                return True
+            handler = self.handlers.get(opcode)
+            if handler is None:
+                self._send(STATUS_ERROR, f"unknown opcode {opcode}".encode())
+                continue
+            try:
+                result = handler(payload)
+            except (ValueError, struct.error) as error:
+                self._send(STATUS_ERROR, str(error).encode())
+            else:
+                self._send(STATUS_OK, result)
+
+    def do_input(self, payload):
+        (buttons,) = payload
+        apply_buttons(self.game, self.buttons, buttons)
+        self.buttons = buttons
+        return b''
+
+    def do_step(self, payload):
+        (frames,) = _U32.unpack(payload)
+        game = self.game
+        for _ in range(frames):
+            if game.done:
+                break
+            game.step()
+        return _U32.pack(game.frame)
+
+    def do_query(self, payload):
+        return self.encode_state(self.game)
+
+    def do_load(self, payload):
+        (number,) = _U16.unpack(payload)
+        self.game.load_level(number)
+        return b''
+
+    def do_frame(self, payload):
+        draw_snapshot(screen, self.game.snapshot())
+        return _FRAME_SIZE.pack(*screen.get_size()) + pygame.image.tobytes(screen, 'RGB')
+
+    def do_version(self, payload):
+        return _U16.pack(PROTOCOL_VERSION)
+
+    @staticmethod
+    def encode_state(game):
+        """Pack the game state: a header, the player, then counted enemy and platform records."""
+        level = game.level
+        player = level.player
+        store, eid = player.store, player.eid
+        flags = (1 if game.idle else 0) | (2 if game.done else 0)
+        parts = [
+            _STATE.pack(game.frame, game.number, MODES.index(game.mode), flags),
+            _PLAYER.pack(store.x[eid], store.y[eid], store.vx[eid], store.vy[eid], player.is_grounded),
+            _U32.pack(len(level.enemies)),
+        ]
+        parts += [_ENEMY.pack(enemy.rect.x, enemy.rect.y, enemy.alive) for enemy in level.enemies]
+        parts.append(_U32.pack(len(level.platforms)))
+        # Read the store's columns directly; levels can have thousands of blocks
+        rects, block_type, was_hit = store.rect, store.block_type, store.was_hit
+        types = {name: index for index, name in enumerate(BLOCK_TYPES)}
+        parts += [_PLATFORM.pack(*rects[eid], types[block_type[eid]], was_hit[eid])
+                  for eid in [platform.eid for platform in level.platforms]]
+        return b''.join(parts)
+
+def serve_control(address, game=None, start_level=1):
+    """Drive the game from a control client instead of the keyboard.
+
+    ``address`` is ``'stdio'`` to talk over stdin/stdout, or the path of a
+    Unix domain socket to listen on; socket clients are served one after
+    another until one of them sends OP_QUIT. In stdio mode set
+    PYGAME_HIDE_SUPPORT_PROMPT=1, or pygame's import banner ends up in the
+    stream.
+    """
+    if game is None:
+        game = Game(start_level)
+    if address == 'stdio':
+        # Anything printed from here on must not land in the protocol stream
+        out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        sys.stdout = sys.stderr
+        try:
+            ControlSession(game, sys.stdin.buffer, out).serve()
+        finally:
+            out.close()
+        return
+
+    if os.path.exists(address):
+        os.unlink(address)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(address)
+        server.listen(1)
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rb') as reader, connection.makefile('wb') as writer:
+                if ControlSession(game, reader, writer).serve():
+                    return
+    finally:
+        server.close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+# --- Session Log ---
+# A compact binary record of a played session. Frames are stored in blocks;
+# each block opens with a keyframe, the whole world state as packed by
+# ControlSession.encode_state, and every later frame in it holds the
+# buttons plus the byte runs of the state that changed since the frame
+# before. Blocks are compressed on their own and listed in an index at the
+# end of the file, so any frame decodes from one block.
+#
+#   header   LOG_MAGIC, uint8 compression, uint32 length, metadata JSON
+#   block    uint32 first frame, uint32 frames, uint32 stored size, uint32 raw size, payload
+#   index    uint32 count, then per block uint32 first frame, uint32 frames, uint64 offset
+#   trailer  uint64 index offset, LOG_INDEX_MAGIC
+#
+# A frame starts with its button mask, ORed with LOG_KEYFRAME or LOG_RESIZED.
+# A keyframe goes on with varint size and the state; any other frame with
+# the new varint size if resized, a varint run count and, per run, varint
+# bytes skipped, varint length and the bytes. A log cut short has no index
+# and is read by scanning its blocks.
+LOG_MAGIC = b'SMBLOG\x00\x02'  # The last byte is the format version, bumped with PROTOCOL_VERSION
+LOG_INDEX_MAGIC = b'SMBLIDX\x00'
+LOG_KEYFRAME_INTERVAL = 300  # Frames per block (5 s at the reference rate)
+LOG_KEYFRAME = 0x80
+LOG_RESIZED = 0x40
+LOG_RUN_GAP = 4  # Unchanged bytes sent as part of a run rather than starting a new one
+LOG_DIFF_SLICE = 256  # Bytes compared at a time when looking for changes
+LOG_COMPRESSION = ('none', 'zlib')
+
+_LOG_HEADER = struct.Struct('<8sBI')
+_LOG_BLOCK = struct.Struct('<IIII')
+_LOG_INDEX_ENTRY = struct.Struct('<IIQ')
+_LOG_TRAILER = struct.Struct('<Q8s')
+_CHANGED_BYTES = re.compile(rb'[^\x00]+')
+
+WorldState = namedtuple('WorldState', 'frame level mode paused done player enemies platforms')
+
+def decode_state(data):
+    """Unpack ControlSession.encode_state bytes into a WorldState."""
+    frame, level, mode, flags = _STATE.unpack_from(data)
+    player = _PLAYER.unpack_from(data, _STATE.size)
+    position = _STATE.size + _PLAYER.size
+    (count,) = _U32.unpack_from(data, position)
+    position += _U32.size
+    end = position + count * _ENEMY.size
+    enemies = list(_ENEMY.iter_unpack(data[position:end]))
+    (count,) = _U32.unpack_from(data, end)
+    position = end + _U32.size
+    platforms = list(_PLATFORM.iter_unpack(data[position:position + count * _PLATFORM.size]))
+    return WorldState(frame, level, MODES[mode], bool(flags & 1), bool(flags & 2),
+                      player, enemies, platforms)
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, position):
+    """(value, position after it) for the varint at ``position``."""
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def changed_runs(previous, state):
+    """[start, end) ranges of ``state`` that differ from ``previous``.
+
+    Bytes past the end of ``previous`` count as zero, which is what a
+    decoder fills a grown state with.
+    """
+    runs = []
+    # Equal slices compare at memcmp speed; only the ones that differ are scanned
+    for base in range(0, len(state), LOG_DIFF_SLICE):
+        new = state[base:base + LOG_DIFF_SLICE]
+        old = previous[base:base + LOG_DIFF_SLICE]
+        if new == old:
+            continue
+        diff = (int.from_bytes(new, 'little') ^ int.from_bytes(old, 'little')).to_bytes(len(new), 'little')
+        for match in _CHANGED_BYTES.finditer(diff):
+            start, end = match.start() + base, match.end() + base
+            if runs and start - runs[-1][1] <= LOG_RUN_GAP:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+    return runs
+
+class SessionRecorder:
+    """Streams the frames of a game to a session log at ``path``.
+
+    Call ``record`` after each step; a block goes to disk every
+    ``keyframe_interval`` frames, and ``close`` writes the index.
+    """
+
+    def __init__(self, path, metadata=None, keyframe_interval=LOG_KEYFRAME_INTERVAL, compression='zlib'):
+        self.file = open(path, 'wb')
+        self.keyframe_interval = keyframe_interval
+        self.compress = compression == 'zlib'
+        metadata = dict(metadata or {}, sim_hz=SIM_HZ, keyframe_interval=keyframe_interval,
+                        started=time.time())
+        encoded = json.dumps(metadata).encode()
+        self.file.write(_LOG_HEADER.pack(LOG_MAGIC, LOG_COMPRESSION.index(compression), len(encoded)))
+        self.file.write(encoded)
+        self.block = bytearray()
+        self.block_frames = 0
+        self.frames = 0
+        self.index = []
+        self.previous = None
+        self.last_frame = None
+
+    def record(self, game, buttons=0):
+        """Add the state ``game`` is in and the BUTTON_* mask that led to it."""
+        if game.frame == self.last_frame:
+            return  # Paused; nothing was simulated
+        self.last_frame = game.frame
+        state = ControlSession.encode_state(game)
+        if self.block_frames == self.keyframe_interval:
+            self._flush()
+        block = self.block
+        if not self.block_frames:
+            block.append(buttons | LOG_KEYFRAME)
+            write_varint(block, len(state))
+            block += state
+        else:
+            resized = len(state) != len(self.previous)
+            block.append(buttons | (LOG_RESIZED if resized else 0))
+            if resized:
+                write_varint(block, len(state))
+            runs = changed_runs(self.previous, state)
+            write_varint(block, len(runs))
+            position = 0
+            for start, end in runs:
+                write_varint(block, start - position)
+                write_varint(block, end - start)
+                block += state[start:end]
+                position = end
+        self.previous = state
+        self.block_frames += 1
+        self.frames += 1
+
+    def _flush(self):
+        if not self.block_frames:
+            return
+        raw = bytes(self.block)
+        stored = zlib.compress(raw) if self.compress else raw
+        first = self.frames - self.block_frames
+        self.index.append((first, self.block_frames, self.file.tell()))
+        self.file.write(_LOG_BLOCK.pack(first, self.block_frames, len(stored), len(raw)))
+        self.file.write(stored)
+        self.block.clear()
+        self.block_frames = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._flush()
+        offset = self.file.tell()
+        parts = [_U32.pack(len(self.index))]
+        parts += [_LOG_INDEX_ENTRY.pack(*entry) for entry in self.index]
+        parts.append(_LOG_TRAILER.pack(offset, LOG_INDEX_MAGIC))
+        self.file.write(b''.join(parts))
+        self.file.close()
+
+class SessionLog:
+    """Reads a session log; ``frame(n)`` decodes any frame from its block's keyframe.
+
+    Reading forward through a block continues from the last decoded frame
+    instead of starting over at the keyframe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        header = self.file.read(_LOG_HEADER.size)
+        if len(header) < _LOG_HEADER.size or header[:len(LOG_MAGIC) - 1] != LOG_MAGIC[:-1]:
+            self.file.close()
+            raise ValueError(f"{path} is not a session log")
+        if header[len(LOG_MAGIC) - 1] != LOG_MAGIC[-1]:
+            self.file.close()
+            raise ValueError(f"{path} is a version {header[len(LOG_MAGIC) - 1]} session log;"
+                             f" this version reads version {LOG_MAGIC[-1]}")
+        _, compression, length = _LOG_HEADER.unpack(header)
+        self.compressed = LOG_COMPRESSION[compression] == 'zlib'
+        self.metadata = json.loads(self.file.read(length))
+        self.data_start = self.file.tell()
+        self.complete = True
+        self.index = self._read_index()
+        if self.index is None:
+            self.complete = False
+            self.index = self._scan()
+        self.firsts = [first for first, _, _ in self.index]
+        self.frames = sum(frames for _, frames, _ in self.index)
+        self._cursor = None  # (block, frame number, frame iterator) of the last read
+
+    def _read_index(self):
+        file = self.file
+        end = file.seek(0, os.SEEK_END)
+        if end - self.data_start < _U32.size + _LOG_TRAILER.size:
+            return None
+        file.seek(end - _LOG_TRAILER.size)
+        offset, magic = _LOG_TRAILER.unpack(file.read(_LOG_TRAILER.size))
+        if magic != LOG_INDEX_MAGIC:
+            return None
+        file.seek(offset)
+        (count,) = _U32.unpack(file.read(_U32.size))
+        data = file.read(count * _LOG_INDEX_ENTRY.size)
+        return list(_LOG_INDEX_ENTRY.iter_unpack(data))
+
+    def _scan(self):
+        """Index of the whole blocks in a log that was never closed."""
+        file = self.file
+        index = []
+        offset = self.data_start
+        while True:
+            file.seek(offset)
+            header = file.read(_LOG_BLOCK.size)
+            if len(header) < _LOG_BLOCK.size:
+                return index
+            first, frames, stored, _ = _LOG_BLOCK.unpack(header)
+            if len(file.read(stored)) < stored:
+                return index
+            index.append((first, frames, offset))
+            offset += _LOG_BLOCK.size + stored
+
+    def __len__(self):
+        return self.frames
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def block_frames(self, block):
+        """Yield (buttons, state bytes) for every frame of block number ``block``."""
+        self.file.seek(self.index[block][2])
+        _, frames, stored, _ = _LOG_BLOCK.unpack(self.file.read(_LOG_BLOCK.size))
+        data = self.file.read(stored)
+        if self.compressed:
+            data = zlib.decompress(data)
+        state = bytearray()
+        position = 0
+        for _ in range(frames):
+            flags = data[position]
+            position += 1
+            if flags & LOG_KEYFRAME:
+                size, position = read_varint(data, position)
+                state[:] = data[position:position + size]
+                position += size
+            else:
+                if flags & LOG_RESIZED:
+                    size, position = read_varint(data, position)
+                    if size < len(state):
+                        del state[size:]
+                    else:
+                        state.extend(bytes(size - len(state)))
+                runs, position = read_varint(data, position)
+                offset = 0
+                for _ in range(runs):
+                    skip, position = read_varint(data, position)
+                    length, position = read_varint(data, position)
+                    offset += skip
+                    state[offset:offset + length] = data[position:position + length]
+                    offset += length
+                    position += length
+            yield flags & ~(LOG_KEYFRAME | LOG_RESIZED), bytes(state)
+
+    def frame(self, number):
+        """(buttons, state bytes) of frame ``number``, counting from 0."""
+        if not 0 <= number < self.frames:
+            raise IndexError(f"frame {number} not in a log of {self.frames} frames")
+        block = bisect.bisect_right(self.firsts, number) - 1
+        cursor = self._cursor
+        if cursor is None or cursor[0] != block or cursor[1] > number:
+            cursor = [block, self.firsts[block], self.block_frames(block)]
+        for _ in range(cursor[1], number + 1):
+            result = next(cursor[2])
+        cursor[1] = number + 1
+        self._cursor = cursor
+        return result
+
+    def state(self, number):
+        """The WorldState of frame ``number``."""
+        return decode_state(self.frame(number)[1])
+
+    def __iter__(self):
+        for block in range(len(self.index)):
+            yield from self.block_frames(block)
+
+def inspect_log(path, frame=None):
+    """Print what a session log holds and, optionally, one decoded frame."""
+    try:
+        log = SessionLog(path)
+    except (OSError, ValueError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    with log:
+        size = os.path.getsize(path)
+        print(f"{path}: {log.frames} frames in {len(log.index)} blocks, {size} bytes"
+              f" ({size / max(1, log.frames):.1f} per frame)"
+              f"{'' if log.complete else ', no index (recording was cut short)'}")
+        print(f"  {json.dumps(log.metadata)}")
+        if frame is not None:
+            if not 0 <= frame < log.frames:
+                print(f"No frame {frame}; frames are 0 to {log.frames - 1}", file=sys.stderr)
+                return 1
+            buttons, data = log.frame(frame)
+            state = decode_state(data)
+            print(f"Frame {frame}: buttons {buttons:#04x}, level {state.level}, {state.mode}"
+                  f"{', paused' if state.paused else ''}{', done' if state.done else ''}")
+            x, y, vx, vy, grounded = state.player
+            print(f"  player at ({x:.1f}, {y:.1f}) moving ({vx:.2f}, {vy:.2f})"
+                  f"{' on the ground' if grounded else ''}")
+            alive = sum(1 for _, _, is_alive in state.enemies if is_alive)
+            print(f"  {len(state.enemies)} enemies ({alive} alive), {len(state.platforms)} platforms")
+    return 0
+
+# --- Render Regression Check ---
+GOLDEN_FRAMES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_frames.txt')
+GOLDEN_CHECKPOINT_FRAMES = 20
+
+# (frames, buttons) segments replayed on every level
+GOLDEN_SCRIPT = (
+    (20, 0),  # Transition in and settle
+    (40, BUTTON_RIGHT),
+    (25, BUTTON_RIGHT | BUTTON_JUMP),
+    (10, BUTTON_RIGHT),
+    (60, BUTTON_RIGHT | BUTTON_RUN),
+    (20, BUTTON_JUMP),
+    (40, BUTTON_LEFT),
+    (30, BUTTON_RIGHT | BUTTON_RUN | BUTTON_JUMP),
+    (15, BUTTON_DOWN),
+)
+
+def use_headless_display():
+    """Reopen the display on SDL's dummy driver at the logical resolution."""
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.quit()
+    pygame.display.init()
+    configure_display()
+
+def frame_hash(surface):
+    """Hash of the surface's raw pixel buffer, read in place."""
+    view = surface.get_view('1')
+    digest = hashlib.blake2b(view, digest_size=16).hexdigest()
+    del view  # Unlocks the surface
+    return digest
+
+def golden_session(number):
+    """Replay GOLDEN_SCRIPT on level ``number``, yielding (frame, hash) at checkpoints."""
+    random.seed(number)  # Particles are the only other input
+    game = Game(start_level=number)
+    buttons = 0
+    frame = 0
+    for frames, next_buttons in GOLDEN_SCRIPT:
+        apply_buttons(game, buttons, next_buttons)
+        buttons = next_buttons
+        for _ in range(frames):
+            game.step()
+            frame += 1
+            if frame % GOLDEN_CHECKPOINT_FRAMES == 0:
+                draw_snapshot(screen, game.snapshot())
+                yield frame, frame_hash(screen)
+
+def read_golden(path):
+    golden = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                number, frame, digest = line.split()
+                golden[int(number), int(frame)] = digest
+    return golden
+
+def render_check(path=GOLDEN_FRAMES_PATH, update=False, dump_dir='golden_failures'):
+    """Compare checkpoint frames of scripted sessions against golden hashes.
+
+    Runs headless at the logical resolution and the reference simulation
+    rate so results do not depend on the machine's display or the options
+    the game was started with. Mismatching frames are saved as PNGs in
+    ``dump_dir``. With ``update`` the golden file is rewritten instead.
+    Returns the number of mismatches.
+    """
+    use_headless_display()
+    configure_simulation(REFERENCE_HZ)
+
+    results = [(number, frame, digest) for number in sorted(LEVEL_DATA)
+               for frame, digest in golden_session(number)]
+    if update:
+        with open(path, 'w') as f:
+            f.write(f"# level frame hash, from {GOLDEN_CHECKPOINT_FRAMES}-frame checkpoints of GOLDEN_SCRIPT\n")
+            for number, frame, digest in results:
+                f.write(f"{number} {frame} {digest}\n")
+        print(f"Wrote {len(results)} golden frames to {path}")
+        return 0
+
+    golden = read_golden(path)
+    failures = [(number, frame) for number, frame, digest in results
+                if golden.get((number, frame)) != digest]
+    if failures:
+        # Replay the failing sessions to dump their frames
+        os.makedirs(dump_dir, exist_ok=True)
+        failed = set(failures)
+        for number in sorted({number for number, _ in failures}):
+            for frame, _ in golden_session(number):
+                if (number, frame) in failed:
+                    pygame.image.save(screen, os.path.join(dump_dir, f"level{number}-frame{frame:04d}.png"))
+        for number, frame in failures:
+            print(f"Mismatch: level {number} frame {frame}", file=sys.stderr)
+        print(f"{len(failures)} of {len(results)} frames differ; images in {dump_dir}", file=sys.stderr)
+    else:
+        print(f"All {len(results)} frames match")
+    return len(failures)
+
+# --- Soak Test ---
+SOAK_SAMPLES = 50            # Measurements taken over a run
+SOAK_FRAMES = 360            # Frames per life: a route into a block, then GOLDEN_SCRIPT
+SOAK_WARMUP = 0.2            # Fraction of samples ignored while caches fill
+SOAK_GROWTH_TOLERANCE = 0.01  # Relative rise below which a series counts as flat
+
+class GCPauseTimer:
+    """Times every garbage collection through ``gc.callbacks``."""
+
+    def __init__(self):
+        self.started = None
+        self.collections = [0, 0, 0]
+        self.total = 0.0
+        self.longest = 0.0
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self.started = time.perf_counter()
+        elif self.started is not None:
+            pause = time.perf_counter() - self.started
+            self.started = None
+            self.collections[info['generation']] += 1
+            self.total += pause
+            self.longest = max(self.longest, pause)
+
+    def take(self):
+        """(collections per generation, total s, longest s) since the last take."""
+        result = (tuple(self.collections), self.total, self.longest)
+        self.collections = [0, 0, 0]
+        self.total = self.longest = 0.0
+        return result
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+def live_surfaces():
+    """Every Surface referenced from a garbage-collected container, by id.
+
+    Surfaces are not GC-tracked themselves, so they are found through
+    whatever lists, dicts and objects hold them.
+    """
+    found = {}
+    for holder in gc.get_objects():
+        for obj in gc.get_referents(holder):
+            if isinstance(obj, pygame.Surface):
+                found[id(obj)] = obj
+    return found
+
+def surface_census(game):
+    """{subsystem: (count, bytes)} for the Surfaces each part of the game holds.
+
+    'other' is every live Surface none of the known holders account for;
+    that is where leaks show up.
+    """
+    level = game.level
+    store = level.store
+    holders = {
+        'entities': store.surf,
+        'player': Player.frames,
+        'enemy frames': (Enemy.normal_surf, Enemy.squished_surf, *Enemy.walk_frames),
+        'static layer': store.static_layer.chunks.values() if store.static_layer else (),
+        'scaled cache': [surf for by_scale in _scaled_surfaces.values() for surf in by_scale.values()],
+        'text': [*_text_cache.values(), *_question_marks.values()],
+        'particle stamps': _particle_stamps.values(),
+        'display': (screen, display.surface, getattr(display, 'window_surface', None), GRADIENT_BACKGROUND),
+    }
+    census = {}
+    known = set()
+    for name, surfaces in holders.items():
+        unique = {id(surf): surf for surf in surfaces if surf is not None}
+        unique = {key: surf for key, surf in unique.items() if key not in known}
+        known.update(unique)
+        census[name] = (len(unique), sum(surface_bytes(surf) for surf in unique.values()))
+    other = [surf for key, surf in live_surfaces().items() if key not in known]
+    census['other'] = (len(other), sum(surface_bytes(surf) for surf in other))
+    return census
+
+def soak_trend(values):
+    """(slope per sample, growing) for a series, ignoring the warm-up.
+
+    A series is growing if the mean of every quarter of it is higher than
+    the quarter before and it rose by more than SOAK_GROWTH_TOLERANCE overall.
+    """
+    values = values[int(len(values) * SOAK_WARMUP):]
+    n = len(values)
+    if n < 4:
+        return 0.0, False
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    slope = (sum((i - mean_x) * (v - mean_y) for i, v in enumerate(values))
+             / sum((i - mean_x) ** 2 for i in range(n)))
+    quarter = n // 4
+    means = [sum(values[i * quarter:(i + 1) * quarter]) / quarter for i in range(4)]
+    rising = all(b > a for a, b in zip(means, means[1:]))
+    rise = means[-1] - means[0]
+    return slope, rising and rise > SOAK_GROWTH_TOLERANCE * max(abs(means[0]), 1)
+
+def soak_route(number):
+    """Inputs that take a fresh life on level ``number`` into a question block.
+
+    The bot tries the level's question blocks in order; empty if it can't
+    reach any of them.
+    """
+    for index, (_, _, _, _, block_type) in enumerate(LEVEL_DATA[number]['platforms']):
+        if block_type == 'question':
+            result = Bot(number, block=index).solve()
+            if result.solved:
+                return result.inputs
+    return []
+
+def soak(resets=100_000, frames=SOAK_FRAMES, lives_per_level=10, samples=SOAK_SAMPLES, top=10,
+         levels=None):
+    """Play headlessly through ``resets`` level resets and report memory trends.
+
+    Each life plays ``frames`` frames, drawing every frame, then restarts the
+    level; every ``lives_per_level`` lives the next level is loaded from
+    scratch instead. A life opens with the bot's route into a question block
+    (see soak_route) and carries on through GOLDEN_SCRIPT, whose cursor runs
+    on from one life to the next, so lives jump, stomp and bounce blocks at
+    different points. tracemalloc, per-subsystem Surface counts and bytes, GC
+    object counts and GC pauses are sampled ``samples`` times. ``levels``
+    defaults to every level. Returns the number of series that kept growing,
+    or 1 if the soak never spawned a particle or hit a block, since flat
+    memory then proves nothing.
+    """
+    use_headless_display()
+    levels = sorted(LEVEL_DATA) if levels is None else levels
+    buttons_by_frame = [buttons for count, buttons in GOLDEN_SCRIPT for _ in range(count)]
+    routes = {number: soak_route(number) for number in levels}
+    for number, route in routes.items():
+        if not route:
+            print(f"Level {number}: no question block the bot can reach", file=sys.stderr)
+
+    game = Game(levels[0])
+    game.restart_level()
+    names = ['traced bytes', 'gc objects', 'particles', 'gc pause max ms']
+    for name in surface_census(game):
+        names += [f'surfaces {name}', f'surface bytes {name}']
+    # Allocated before tracing starts so the measurements don't show up as growth
+    every = max(1, resets // samples)
+    samples = resets // every + (resets % every != 0)
+    series = {name: array('d', bytes(8 * samples)) for name in names}
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    taken = 0
+    baseline = None
+
+    pauses = GCPauseTimer()
+    gc.callbacks.append(pauses)
+    counted = ('particles_spawned', 'blocks_hit', 'deaths')
+    counts_before = {name: metrics.counters[name] for name in counted}
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        cursor = 0
+        for life in range(1, resets + 1):
+            route = routes[game.number]
+            buttons = 0
+            for frame in range(frames):
+                if frame < len(route):
+                    next_buttons = route[frame]
                 else:
-                    # Player dies - restart level
-                    transition_effect(screen, 'out')
+                    next_buttons = buttons_by_frame[cursor % len(buttons_by_frame)]
+                    cursor += 1
+                apply_buttons(game, buttons, next_buttons)
+                buttons = next_buttons
+                game.step()
+                draw_snapshot(screen, game.snapshot())
+            apply_buttons(game, buttons, 0)
+            if life % lives_per_level == 0:
+                game.load_level(levels[life // lives_per_level % len(levels)])
+            else:
+                game.restart_level()
+
+            if life % every == 0 or life == resets:
+                collections, total, longest = pauses.take()
+                gc.collect()  # Settle garbage so only live memory is measured
+                snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+                sample = {
+                    'traced bytes': sum(trace.size for trace in snapshot.traces),
+                    'gc objects': len(gc.get_objects()),
+                    'particles': len(game.particles),
+                    'gc pause max ms': longest * 1000,
+                }
+                for name, (count, size) in surface_census(game).items():
+                    sample[f'surfaces {name}'] = count
+                    sample[f'surface bytes {name}'] = size
+                for name, value in sample.items():
+                    series[name][taken] = value
+                taken += 1
+                if baseline is None and taken > samples * SOAK_WARMUP:
+                    baseline = snapshot
+                del snapshot, sample
+    finally:
+        gc.callbacks.remove(pauses)
+        final = tracemalloc.take_snapshot().filter_traces(ignore) if baseline is not None else None
+        tracemalloc.stop()
+
+    elapsed = time.perf_counter() - started
+    counts = {name: metrics.counters[name] - counts_before[name] for name in counted}
+    print(f"Soak: {resets} resets, {resets * frames} frames in {elapsed:.0f}s")
+    print(f"{counts['particles_spawned']} particles spawned, {counts['blocks_hit']} blocks hit,"
+          f" {counts['deaths']} deaths")
+    print(f"{'series':32} {'first':>14} {'last':>14} {'slope/sample':>14}")
+    growing = []
+    for name, values in series.items():
+        values = values[:taken]
+        slope, grows = soak_trend(values)
+        flag = '  GROWING' if grows and name != 'gc pause max ms' else ''
+        if flag:
+            growing.append(name)
+        print(f"{name:32} {values[0]:14.0f} {values[-1]:14.0f} {slope:14.2f}{flag}")
+    if final is not None:
+        print(f"Largest allocation growth since warm-up (top {top}):")
+        grown = [stat for stat in final.compare_to(baseline, 'lineno') if stat.size_diff > 0]
+        for stat in grown[:top]:
+            print(f"  {stat}")
+    if growing:
+        print(f"{len(growing)} series kept growing: {', '.join(growing)}", file=sys.stderr)
+    if not counts['particles_spawned'] or not counts['blocks_hit']:
+        print("The soak spawned no particles or hit no blocks, so it says nothing about them",
+              file=sys.stderr)
+        return len(growing) or 1
+    return len(growing)
+
+# --- Search Bot ---
+# Plays a level by beam search over button sequences, simulated with the
+# real Game.step. Every branch restores the level from Level.capture, so a
+# node costs a state copy plus BOT_ACTION_FRAMES steps and nothing else.
+# That comes to 20-35k simulated frames/s on one core, two thirds of it in
+# Game.step itself (about 27 us a frame), so cheaper copies could not take
+# the search past about 40k frames/s.
+BOT_ACTION_FRAMES = 4  # Frames each choice is held for
+BOT_BEAM_WIDTH = 128  # Level 2 needs more than 64 once wrapping round the screen is ruled out
+BOT_MAX_DEPTH = 600    # Choices, i.e. BOT_MAX_DEPTH * BOT_ACTION_FRAMES frames
+BOT_GRID = 16          # Pixels; nodes this close in the same controller state are merged
+BOT_ACTIONS = (
+    BUTTON_RIGHT | BUTTON_RUN,
+    BUTTON_RIGHT | BUTTON_RUN | BUTTON_JUMP,
+    BUTTON_RIGHT,
+    BUTTON_RIGHT | BUTTON_JUMP,
+    BUTTON_JUMP,
+    0,
+    BUTTON_LEFT | BUTTON_RUN,
+    BUTTON_LEFT | BUTTON_RUN | BUTTON_JUMP,
+    BUTTON_DOWN,
+)
+
+BotNode = namedtuple('BotNode', 'cost state buttons parent')
+BotResult = namedtuple('BotResult', 'solved inputs nodes frames elapsed timings')
+
+def bot_goal(level):
+    """Where the bot heads for: the exit pipe, or the right edge of the last level."""
+    if level.data['exit_pos']:
+        return level.data['exit_pos']
+    return (level.width - 10, level.player.rect.centery)
+
+class Bot:
+    """Beam search for a button sequence that finishes one level.
+
+    ``inputs`` of a result holds one BUTTON_* mask per frame; feeding them
+    through ``apply_buttons`` from ``Game.load_level`` replays the solution
+    (see ``play_inputs``). With ``block``, the index of a question block in
+    the level's platforms, the search hits that block instead.
+    """
+
+    def __init__(self, number, beam_width=BOT_BEAM_WIDTH, action_frames=BOT_ACTION_FRAMES,
+                 max_depth=BOT_MAX_DEPTH, block=None):
+        # Particles are never drawn during the search, so don't make them
+        self.game = Game(number, particles=False)
+        self.game.restart_level()
+        self.level = self.game.level
+        self.beam_width = beam_width
+        self.action_frames = action_frames
+        self.max_depth = max_depth
+        if block is None:
+            self.target = None
+            self.goal = bot_goal(self.level)
+        else:
+            self.target = self.level.platform_ids[block][1]
+            rect = self.level.store.rect[self.target]
+            self.goal = (rect.centerx, rect.bottom)
+        self.timings = dict.fromkeys(('restore', 'simulate', 'capture', 'rank'), 0.0)
+        self.nodes = 0
+
+    def expand(self, node, buttons):
+        """Hold ``buttons`` from ``node``; returns (finished, child).
+
+        ``child`` is None when the level was finished, the player died or
+        it wrapped around a screen edge.
+        """
+        game, level, timings = self.game, self.level, self.timings
+        started = time.perf_counter()
+        level.restore(node.state)
+        game.resume()
+        restored = time.perf_counter()
+        apply_buttons(game, node.buttons, buttons)
+        player = level.player
+        for _ in range(self.action_frames):
+            game.step()
+            if game.mode != MODE_PLAY or player.wrapped:
+                break
+        simulated = time.perf_counter()
+        timings['restore'] += restored - started
+        timings['simulate'] += simulated - restored
+        self.nodes += 1
+        if player.wrapped:
+            # Wrapping round the screen lands far from where the player was
+            # heading; routes through it are not solutions
+            return False, None
+        if self.target is not None:
+            if level.store.was_hit[self.target]:
+                return True, None
+        elif game.mode == MODE_PIPE or game.mode == MODE_COMPLETE:
+            return True, None
+        if game.mode != MODE_PLAY or level.player.rect.top > SCREEN_HEIGHT:
+            return False, None
+        rect = level.player.rect
+        cost = abs(rect.centerx - self.goal[0]) + 0.5 * abs(rect.centery - self.goal[1])
+        child = BotNode(cost, level.capture(), buttons, node)
+        timings['capture'] += time.perf_counter() - simulated
+        return False, child
+
+    def key(self, node):
+        """What makes two nodes the same search state."""
+        eid = self.level.player.eid
+        x, y = node.state[0]['moved'][eid][:2]
+        return x // BOT_GRID, y // BOT_GRID, node.state[1]
+
+    def solve(self):
+        level = self.level
+        player = level.player
+        player.drawing = False
+        root = BotNode(0.0, level.capture(), 0, None)
+        beam = [root]
+        found = None
+        frames_per_node = self.action_frames
+        started = time.perf_counter()
+        try:
+            for depth in range(self.max_depth):
+                children = []
+                for node in beam:
+                    for buttons in BOT_ACTIONS:
+                        done, child = self.expand(node, buttons)
+                        if done:
+                            found = (node, buttons)
+                            break
+                        if child is not None:
+                            children.append(child)
+                    if found:
+                        break
+                if found or not children:
                     break
+                ranked = time.perf_counter()
+                children.sort(key=lambda child: child.cost)
+                beam = []
+                seen = set()
+                for child in children:
+                    key = self.key(child)
+                    if key not in seen:
+                        seen.add(key)
+                        beam.append(child)
+                        if len(beam) == self.beam_width:
+                            break
+                self.timings['rank'] += time.perf_counter() - ranked
+        finally:
+            elapsed = time.perf_counter() - started
+            level.restore(root.state)
+            player.drawing = True
+            player.draw_player()
+        inputs = []
+        if found:
+            node, buttons = found
+            choices = [buttons]
+            while node.parent is not None:
+                choices.append(node.buttons)
+                node = node.parent
+            for buttons in reversed(choices):
+                inputs.extend([buttons] * frames_per_node)
+        return BotResult(found is not None, inputs, self.nodes, self.nodes * frames_per_node,
+                         elapsed, dict(self.timings))
 
-            # Check for level completion (reach exit pipe)
-            if level_data['exit_pos']:
-                exit_x, exit_y = level_data['exit_pos']
-                if (abs(player.rect.centerx - exit_x) < 30 and 
-                    abs(player.rect.centery - exit_y) < 50):
-                    keys = pygame.key.get_pressed()
-                    if keys[pygame.K_DOWN] or keys[pygame.K_s]:
-                        # Enter pipe animation
-                        for i in range(30):
-                            player.rect.y += 2
-                            draw_game(screen, all_sprites, particles, current_level)
-                            pygame.display.flip()
-                            clock.tick(FPS)
-                        
-                        level_complete = True
-                        current_level += 1
-                        if current_level > 5:
-                            game_complete = True
-                        else:
-                            transition_effect(screen, 'out')
-            elif current_level == 5:
-                # Last level - check if reached the right edge
-                if player.rect.right >= SCREEN_WIDTH - 10:
-                    game_complete = True
-                    level_complete = True
-
-            # Draw everything
-            draw_game(screen, all_sprites, particles, current_level)
-            
-            # Draw pipe entry hint
-            if level_data['exit_pos']:
-                exit_x, exit_y = level_data['exit_pos']
-                if (abs(player.rect.centerx - exit_x) < 40 and 
-                    abs(player.rect.centery - exit_y) < 60):
-                    hint_text = font.render("Press DOWN to enter", True, TEXT_COLOR)
-                    hint_rect = hint_text.get_rect(center=(exit_x, exit_y - 80))
-                    screen.blit(hint_text, hint_rect)
-            
-            pygame.display.flip()
-    
-    # Game complete screen
-    screen.fill(BACKGROUND_COLOR)
-    complete_text = big_font.render("GAME COMPLETE!", True, TEXT_COLOR)
-    complete_rect = complete_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
-    screen.blit(complete_text, complete_rect)
-    
-    thanks_text = font.render("Thanks for playing!", True, TEXT_COLOR)
-    thanks_rect = thanks_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
-    screen.blit(thanks_text, thanks_rect)
-    
-    pygame.display.flip()
-    pygame.time.wait(3000)
+def play_inputs(game, inputs, render=False, session_log=None):
+    """Feed per-frame BUTTON_* masks to ``game``; True if it left play mode by finishing."""
+    previous = 0
+    pacer = FramePacer(SIM_HZ)
+    for buttons in inputs:
+        if render:
+            pacer.wait()
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return False
+        apply_buttons(game, previous, buttons)
+        previous = buttons
+        game.step()
+        if session_log is not None:
+            session_log.record(game, buttons)
+        if render:
+            render_frame(game.snapshot())
+        if game.mode == MODE_PIPE or game.mode == MODE_COMPLETE:
+            return True
+        if game.mode != MODE_PLAY:
+            return False
+    return False
 
-def draw_game(screen, all_sprites, particles, level):
-    # Use pre-rendered gradient background
-    screen.blit(GRADIENT_BACKGROUND, (0, 0))
-    
-    # Draw sprites
-    for sprite in all_sprites:
-        screen.blit(sprite.surf, sprite.rect)
-    
-    # Draw particles
+def run_bot(number, beam_width=BOT_BEAM_WIDTH, watch=False, session_log=None):
+    """Solve level ``number``, print the search report and optionally replay it."""
+    bot = Bot(number, beam_width)
+    result = bot.solve()
+    elapsed = result.elapsed or 1e-9
+    if result.solved:
+        print(f"Level {number}: solved in {len(result.inputs)} frames"
+              f" ({len(result.inputs) / REFERENCE_HZ:.1f}s of play)")
+    else:
+        print(f"Level {number}: no solution found")
+    print(f"{result.nodes} nodes, {result.frames} simulated frames in {result.elapsed:.2f}s:"
+          f" {result.nodes / elapsed:.0f} nodes/s, {result.frames / elapsed:.0f} frames/s")
+    for phase, seconds in result.timings.items():
+        print(f"  {phase:10} {seconds:8.3f}s {seconds / elapsed:6.1%}")
+    if result.solved:
+        # The search leaves its level as it found it, so replay on that
+        game = Game(number, level=bot.level)
+        game.restart_level()
+        if not play_inputs(game, result.inputs, render=watch, session_log=session_log):
+            print("Replay did not finish the level", file=sys.stderr)
+            return 1
+    return 0 if result.solved else 1
+
+def check_generated(seeds, beam_width=BOT_BEAM_WIDTH, **options):
+    """Have the bot finish the generated level for each seed; returns how many it could not.
+
+    ``options`` are passed on to generate_level. A level only counts as
+    finished if replaying the bot's inputs in a fresh Game finishes it too.
+    """
+    failed = []
+    for seed in seeds:
+        data = generate_level(seed, **options)
+        width = max(x + w for x, _, w, _, _ in data['platforms'])
+        number = add_level(data)
+        try:
+            result = Bot(number, beam_width).solve()
+            finished = False
+            if result.solved:
+                game = Game(number)
+                game.restart_level()
+                finished = play_inputs(game, result.inputs)
+        finally:
+            del LEVEL_DATA[number]
+        if finished:
+            print(f"Seed {seed}: {width}px wide, finished in {len(result.inputs)} frames")
+        else:
+            print(f"Seed {seed}: {width}px wide, exit not reached", file=sys.stderr)
+            failed.append(seed)
+    if failed:
+        print(f"{len(failed)} of {len(seeds)} generated levels could not be finished", file=sys.stderr)
+    else:
+        print(f"All {len(seeds)} generated levels finished")
+    return len(failed)
+
+# --- Spectator View ---
+# Many games in one window. Each visible tile has its own small surface that
+# draw_snapshot renders into at tile scale, so every tile shares one set of
+# cached resized sprites. Tiles off the current page are simulated but
+# never drawn.
+SPECTATOR_HZ = 15        # Redraws per second for each tile
+SPECTATOR_TILES = 16     # Tiles per page; PageUp/PageDown flips pages
+SPECTATOR_GAP = 2
+SPECTATOR_PAGE_KEYS = {pygame.K_PAGEUP: -1, pygame.K_PAGEDOWN: 1}
+
+class ReplaySession:
+    """A game that plays a fixed list of per-frame button masks on a loop."""
+
+    def __init__(self, number, inputs, offset=0, level=None):
+        self.game = Game(number, level=level)
+        self.game.restart_level()
+        self.game.keys = HeldKeys()
+        self.inputs = inputs
+        self.cursor = offset % max(1, len(inputs))
+        self.previous = 0
+
+    def step(self):
+        game = self.game
+        if self.cursor >= len(self.inputs) or game.mode != MODE_PLAY:
+            game.restart_level()
+            self.cursor = 0
+        buttons = self.inputs[self.cursor] if self.inputs else 0
+        apply_buttons(game, self.previous, buttons)
+        self.previous = buttons
+        self.cursor += 1
+        game.step()
+
+def tile_rects(bounds, count, gap=SPECTATOR_GAP):
+    """Rects for ``count`` tiles in a grid filling ``bounds`` at the game's aspect ratio."""
+    columns = math.ceil(math.sqrt(count * bounds[0] * SCREEN_HEIGHT / (bounds[1] * SCREEN_WIDTH)))
+    columns = max(1, min(count, columns))
+    rows = math.ceil(count / columns)
+    cell_w, cell_h = bounds[0] // columns, bounds[1] // rows
+    w = min(cell_w - gap, (cell_h - gap) * SCREEN_WIDTH // SCREEN_HEIGHT)
+    h = w * SCREEN_HEIGHT // SCREEN_WIDTH
+    return [pygame.Rect(column * cell_w + (cell_w - w) // 2, row * cell_h + (cell_h - h) // 2, w, h)
+            for row in range(rows) for column in range(columns)][:count]
+
+class Spectator:
+    """Composites the games of ``sessions`` onto ``target``, one page of tiles at a time.
+
+    Each tile is redrawn SPECTATOR_HZ times a second, the tiles taking
+    turns so the work is spread evenly over frames, and only when its
+    picture changed. The per-frame cost depends on the tiles on the page,
+    not on how many games are running.
+    """
+
+    def __init__(self, target, sessions, tiles=SPECTATOR_TILES, hz=SPECTATOR_HZ, frame_hz=None):
+        self.target = target
+        self.sessions = sessions
+        self.per_page = max(1, min(tiles, len(sessions)))
+        self.rects = tile_rects(target.get_size(), self.per_page)
+        size = self.rects[0].size
+        self.surfaces = [opaque_surface(size) for _ in self.rects]
+        self.every = max(1, round((SIM_HZ if frame_hz is None else frame_hz) / hz))
+        self.page = 0
+        self.drawn = [None] * self.per_page
+        self.frame = 0
+        self.redraws = 0
+
+    @property
+    def pages(self):
+        return math.ceil(len(self.sessions) / self.per_page)
+
+    def flip(self, delta):
+        self.page = (self.page + delta) % self.pages
+        self.drawn = [None] * self.per_page
+        self.target.fill(BLACK)
+
+    def draw(self):
+        """Redraw the tiles that are due; True if anything on ``target`` changed."""
+        changed = False
+        first = self.page * self.per_page
+        for slot, rect in enumerate(self.rects):
+            index = first + slot
+            if index >= len(self.sessions):
+                break
+            due = (self.frame + slot) % self.every == 0
+            if not due and self.drawn[slot] is not None:
+                continue
+            game = self.sessions[index].game
+            snapshot = game.snapshot()._replace(hint=None)
+            if same_picture(snapshot, self.drawn[slot]):
+                continue
+            surface = self.surfaces[slot]
+            draw_snapshot(surface, snapshot)
+            label = render_text(font, f"#{index + 1} 1-{game.number}", TEXT_COLOR)
+            if blit_audit is not None:
+                blit_audit.check(surface, (label,))
+                blit_audit.check(self.target, (surface,))
+            surface.blit(label, (2, surface.get_height() - label.get_height() - 2))
+            self.target.blit(surface, rect)
+            self.drawn[slot] = snapshot
+            self.redraws += 1
+            changed = True
+        self.frame += 1
+        return changed
+
+def spectate(count, tiles=SPECTATOR_TILES, hz=SPECTATOR_HZ, frames=None, levels=None):
+    """Run ``count`` bot replays, one per level of ``levels`` in turn, and watch them tiled.
+
+    Each level is solved once with Bot and every session on that level
+    replays the solution from a different starting point. Runs until the
+    window is closed, or for ``frames`` frames.
+    """
+    numbers = sorted(LEVEL_DATA) if levels is None else levels
+    solutions = {}
+    levels = {}  # The level each bot searched, handed to the first session on it
+    for number in numbers[:count]:
+        bot = Bot(number)
+        result = bot.solve()
+        solutions[number] = result.inputs
+        levels[number] = bot.level
+        print(f"Level {number}: {'solved' if result.solved else 'no solution'}"
+              f" ({result.nodes} nodes in {result.elapsed:.1f}s)", file=sys.stderr)
+    sessions = []
+    for i in range(count):
+        number = numbers[i % len(numbers)]
+        sessions.append(ReplaySession(number, solutions[number], offset=i * 7, level=levels.pop(number, None)))
+    screen.fill(BLACK)
+    spectator = Spectator(screen, sessions, tiles, hz)
+    pacer = FramePacer(SIM_HZ)
+    frame = 0
+    while frames is None or frame < frames:
+        metrics.frame(pacer.wait())
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return
+            if event.type == pygame.KEYDOWN and event.key in SPECTATOR_PAGE_KEYS:
+                spectator.flip(SPECTATOR_PAGE_KEYS[event.key])
+        started = time.perf_counter()
+        for session in sessions:
+            session.step()
+        metrics.time('simulation', time.perf_counter() - started)
+        started = time.perf_counter()
+        if spectator.draw():
+            metrics.time('render', time.perf_counter() - started)
+            present()
+        frame += 1
+
+# --- Sampling Profiler ---
+# A background thread looks at the game loop's stack every few ms, which
+# costs a fraction of a percent where cProfile would slow every call down.
+PROFILE_KEY = pygame.K_F9
+PROFILE_INTERVAL_MS = 5
+PROFILE_DIR = 'profiles'
+
+class SamplingProfiler:
+    """Samples the stacks of the watched threads and counts them per level and mode.
+
+    Counts are written as collapsed stacks (``root;caller;callee count``
+    lines, the input of flamegraph.pl, speedscope and friends) to
+    DIR/SESSION-levelN-MODE.folded when the game moves to another level and
+    when the profiler stops. Files are appended to, so stopping and starting
+    again during a level adds to the same flame graph.
+    """
+
+    def __init__(self, game, directory=PROFILE_DIR, interval_ms=PROFILE_INTERVAL_MS):
+        self.game = game
+        self.directory = directory
+        self.interval = interval_ms / 1000
+        self.threads = {threading.get_ident(): threading.current_thread().name}
+        self.session = time.strftime('%Y%m%d-%H%M%S')
+        self.counts = {}
+        self.labels = {}
+        self.number = None
+        self.samples = 0
+        self.written = set()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def watch(self, thread):
+        """Sample ``thread`` as well, e.g. the simulation thread in threaded mode."""
+        self.threads[thread.ident] = thread.name
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.running:
+            return
+        self.stopping.clear()
+        self.number = self.game.number
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        print(f"Profiling every {self.interval * 1000:g} ms (F9 to stop)", file=sys.stderr)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.flush()
+        print(f"Profile: {self.samples} samples in {len(self.written)} files under {self.directory}/",
+              file=sys.stderr)
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = self.labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self):
+        game, threads, label = self.game, self.threads, self.label
+        while not self.stopping.wait(self.interval):
+            if game.number != self.number:
+                self.flush()
+                self.number = game.number
+            frames = sys._current_frames()
+            by_stack = self.counts.setdefault((game.number, game.mode), {})
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name)
+                stack.reverse()
+                key = ';'.join(stack)
+                by_stack[key] = by_stack.get(key, 0) + 1
+                self.samples += 1
+            del frames
+
+    def flush(self):
+        """Append everything counted so far to the level/mode files and start over."""
+        counts, self.counts = self.counts, {}
+        if not counts:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for (number, mode), by_stack in counts.items():
+            path = os.path.join(self.directory, f"{self.session}-level{number}-{mode}.folded")
+            with open(path, 'a') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in by_stack.items())
+            self.written.add(path)
+
+# --- Game Loop Function ---
+def game_loop(threaded=False, start_level=1, profile=False, profile_dir=PROFILE_DIR, watcher=None,
+              session_log=None):
+    game = Game(start_level, prefetch=True)
+    profiler = SamplingProfiler(game, profile_dir)
+    if profile:
+        profiler.start()
+    try:
+        if threaded:
+            return threaded_game_loop(game, profiler, session_log)
+        return single_threaded_loop(game, profiler, watcher, session_log)
+    finally:
+        profiler.stop()
+
+def single_threaded_loop(game, profiler=None, watcher=None, session_log=None):
+    drawn = game.snapshot()
+    render_frame(drawn)
+    pacer = FramePacer(SIM_HZ)
+    while not game.done:
+        if game.idle:
+            # Sleep until input arrives, waking now and then to redraw
+            pending = wait_events(IDLE_REDRAW_MS)
+            metrics.frame_gap()
+            pacer.reset()
+        else:
+            metrics.frame(pacer.wait())
+            pending = pygame.event.get()
+        
+        # The frame's one input sample: everything up to now, then the step
+        stamp = time.perf_counter()
+        for event in pending:
+            if event.type == pygame.QUIT:
+                return
+            if event.type == pygame.WINDOWEXPOSED:
+                drawn = None
+            if event.type == pygame.KEYDOWN and event.key == PROFILE_KEY and profiler is not None:
+                profiler.toggle()
+            game.handle_event(event, stamp)
+        if watcher is not None and watcher.poll(game):
+            drawn = None  # Baked chunks were redrawn in place
+
+        timed_step(game)
+        if session_log is not None:
+            session_log.record(game, held_buttons(game.read_keys()))
+        snapshot = game.snapshot()
+        # Skip the draw and present when the picture hasn't changed
+        if not same_picture(snapshot, drawn):
+            render_frame(snapshot)
+        drawn = snapshot
+
+# --- Render Pass ---
+VIEWPORT = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+PARTICLE_COLORKEY = (255, 0, 255)
+_particle_stamps = {}
+_text_cache = {}
+
+def render_text(text_font, text, color):
+    """Rendered text, cached so unchanged HUD lines are not re-rendered every frame."""
+    key = (id(text_font), text, color)
+    surf = _text_cache.get(key)
+    if surf is None:
+        metrics.count('text_cache_misses')
+        if len(_text_cache) > 256:
+            _text_cache.clear()
+        with font_lock:
+            surf = _text_cache[key] = prepare_surface(text_font.render(text, True, color))
+    else:
+        metrics.count('text_cache_hits')
+    return surf
+
+def particle_stamp(color, radius):
+    """Pre-rendered particle disc; blit it at (x - radius, y - radius)."""
+    key = (color, radius)
+    stamp = _particle_stamps.get(key)
+    if stamp is None:
+        metrics.count('stamp_cache_misses')
+        size = 2 * radius + 1
+        stamp = keyed_surface((size, size), PARTICLE_COLORKEY)
+        pygame.draw.circle(stamp, color, (radius, radius), radius)
+        _particle_stamps[key] = stamp
+    else:
+        metrics.count('stamp_cache_hits')
+    return stamp
+
+def entity_items(store, viewport=VIEWPORT):
+    """(surface, (x, y)) pairs in logical pixels for what is inside ``viewport``.
+
+    Positions are relative to the viewport's top left. Items are in layer
+    order, with the static layer (if the store has one) at the platform
+    layer.
+    """
+    surfs, rects = store.surf, store.rect
+    visible = store.visible(viewport)
+    items = [(surfs[eid], rects[eid].topleft) for eid in visible]
+    if store.static_layer is not None:
+        layer = store.layer
+        split = next((i for i, eid in enumerate(visible) if layer[eid] >= LAYER_PLATFORM), len(visible))
+        items[split:split] = store.static_layer.items(viewport)
+    ox, oy = viewport.topleft
+    if ox or oy:
+        items = [(surf, (x - ox, y - oy)) for surf, (x, y) in items]
+    return items
+
+def scale_items(items, scale):
+    if scale == UNSCALED:
+        return items
+    sx, sy = scale
+    return [(scaled_surface(surf, scale), (int(x * sx), int(y * sy))) for surf, (x, y) in items]
+
+def particle_states(particles, camera=0):
+    """(color, size, x, y) for every particle that is still visible, ``camera`` px scrolled."""
+    states = []
     for particle in particles:
-        particle.draw(screen)
-    
-    # UI
-    fps_text = font.render(f"FPS: {int(clock.get_fps())}", True, TEXT_COLOR)
-    screen.blit(fps_text, (10, 10))
-    
-    level_text = font.render(f"World 1-{level}", True, TEXT_COLOR)
-    screen.blit(level_text, (SCREEN_WIDTH - 100, 10))
-    
+        if particle.life > 0:
+            size = int(4 * (particle.life / particle.max_life))
+            if size > 0:
+                states.append((particle.color, size, particle.x - camera, particle.y))
+    return states
+
+def particle_blits(states, scale=UNSCALED):
+    sx, sy = scale
+    items = []
+    for color, size, x, y in states:
+        radius = max(1, int(size * sx))
+        items.append((particle_stamp(color, radius), (int(x * sx) - radius, int(y * sy) - radius)))
+    return items
+
+def hud_blits(level, scale=UNSCALED, hint=None):
+    fps = clock.get_fps()
+    fps_text = render_text(font, f"FPS: {int(fps) if math.isfinite(fps) else 0}", TEXT_COLOR)
+    level_text = render_text(font, f"World 1-{level}", TEXT_COLOR)
     # Controls hint
-    controls_text = font.render("WASD/Arrows to move, SPACE/UP to jump, SHIFT/Z to run", True, TEXT_COLOR)
+    controls_text = render_text(font, "WASD/Arrows to move, SPACE/UP to jump, SHIFT/Z to run", TEXT_COLOR)
     controls_rect = controls_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT - 20))
-    screen.blit(controls_text, controls_rect)
+    items = [(fps_text, (10, 10)), (level_text, (SCREEN_WIDTH - 100, 10)), (controls_text, controls_rect.topleft)]
+    # Pipe entry hint
+    if hint is not None:
+        hint_text = render_text(font, "Press DOWN to enter", TEXT_COLOR)
+        items.append((hint_text, hint_text.get_rect(center=hint).topleft))
+    return scale_items(items, scale)
+
+def draw_world(screen, items, particle_list, level, hint=None):
+    """Draw one gameplay frame from entity items and particle states."""
+    # ``screen`` may be any size; drawing is scaled from logical pixels to fit
+    scale = surface_scale(screen)
+    if scale == UNSCALED:
+        background = GRADIENT_BACKGROUND
+    else:
+        background = scaled_surface(GRADIENT_BACKGROUND, scale)
+
+    # One batched submission: background, visible entities, particles, UI
+    batch = [(background, (0, 0))]
+    batch += scale_items(items, scale)
+    batch += particle_blits(particle_list, scale)
+    batch += hud_blits(level, scale, hint)
+    if blit_audit is not None:
+        blit_audit.check(screen, [surf for surf, _ in batch])
+    screen.blits(batch, doreturn=False)
 
 # --- Main Program ---
-def main():
-    # Start screen
+def parse_size(text):
+    try:
+        w, h = (int(n) for n in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}")
+    return (w, h)
+
+def positive_int(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a whole number, got {text!r}")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=GAME_TITLE)
+    parser.add_argument('--render-size', type=parse_size, default=(SCREEN_WIDTH, SCREEN_HEIGHT),
+                        help="internal render resolution, e.g. 400x300 (default: %(default)s)")
+    parser.add_argument('--window-size', type=parse_size, default=None,
+                        help="output window size; the frame is integer-scaled into it")
+    parser.add_argument('--fullscreen', action='store_true',
+                        help="present fullscreen at desktop resolution")
+    parser.add_argument('--present', choices=('window', 'scaled', 'renderer'), default='window',
+                        help="how the render target reaches the window (default: %(default)s)")
+    parser.add_argument('--pacing', choices=PACING_STRATEGIES, default=PACING,
+                        help="how frames wait for their deadline; vsync needs --present scaled or "
+                             "renderer (default: %(default)s)")
+    parser.add_argument('--sim-hz', type=positive_int, default=FPS,
+                        help="simulation steps per second; motion matches the default rate between collisions,"
+                             " but contacts are resolved per step and can differ (default: %(default)s)")
+    parser.add_argument('--threaded', action='store_true',
+                        help="simulate on a separate thread from rendering")
+    parser.add_argument('--asyncio', action='store_true', dest='use_asyncio',
+                        help="drive the game loop from an asyncio event loop")
+    parser.add_argument('--control', metavar='ADDRESS', default=None,
+                        help="serve the automation protocol on a Unix socket path, or 'stdio'")
+    capture = parser.add_mutually_exclusive_group()
+    capture.add_argument('--capture', metavar='BASE', default=None,
+                         help="record raw frames to BASE.NNNN.raw chunks indexed by BASE.idx")
+    capture.add_argument('--capture-pipe', metavar='COMMAND', default=None,
+                         help="stream raw frames to COMMAND's stdin ({width}, {height}, {pix_fmt}, {fps} expand)")
+    parser.add_argument('--capture-queue', type=int, default=CAPTURE_QUEUE_FRAMES,
+                        help="frames buffered for the capture writer (default: %(default)s)")
+    parser.add_argument('--metrics', metavar='PATH', default=None,
+                        help="publish frame-time histograms and counters to PATH "
+                             "(Prometheus textfile, or JSON lines if it ends in .jsonl)")
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL, metavar='SECONDS',
+                        help="how often --metrics is written (default: %(default)s)")
+    parser.add_argument('--record', metavar='PATH', default=None,
+                        help="record the session (inputs and world state) to a binary session log at PATH")
+    parser.add_argument('--record-compression', choices=LOG_COMPRESSION, default='zlib',
+                        help="how --record compresses each block of frames (default: %(default)s)")
+    parser.add_argument('--inspect-log', metavar='PATH', default=None,
+                        help="describe the session log at PATH and exit")
+    parser.add_argument('--log-frame', type=int, metavar='N', default=None,
+                        help="with --inspect-log, also decode frame N")
+    parser.add_argument('--render-check', nargs='?', const=GOLDEN_FRAMES_PATH, default=None, metavar='GOLDEN',
+                        help="replay scripted sessions and compare frames against golden hashes")
+    parser.add_argument('--update-golden', action='store_true',
+                        help="with --render-check, rewrite the golden hashes instead")
+    parser.add_argument('--soak', type=int, metavar='RESETS', default=None,
+                        help="play headlessly through RESETS level resets and report memory growth")
+    parser.add_argument('--soak-frames', type=int, default=SOAK_FRAMES,
+                        help="frames played per life in --soak (default: %(default)s)")
+    parser.add_argument('--audit-blits', action='store_true',
+                        help="log blits whose source pixel format differs from the target's, "
+                             "with counts per call site on exit")
+    parser.add_argument('--profile', action='store_true',
+                        help="start the sampling profiler at once (F9 toggles it in game)")
+    parser.add_argument('--profile-dir', metavar='DIR', default=PROFILE_DIR,
+                        help="where profiles are written as collapsed stacks (default: %(default)s)")
+    parser.add_argument('--bot', action='store_true',
+                        help="solve the level by search and report how the search went")
+    parser.add_argument('--bot-beam', type=int, default=BOT_BEAM_WIDTH, metavar='WIDTH',
+                        help="nodes kept per search step for --bot (default: %(default)s)")
+    parser.add_argument('--bot-watch', action='store_true',
+                        help="with --bot, play the solution on screen afterwards")
+    parser.add_argument('--spectate', type=int, metavar='N', default=None,
+                        help="run N bot replays and show them tiled in one window")
+    parser.add_argument('--spectate-tiles', type=int, default=SPECTATOR_TILES, metavar='TILES',
+                        help="tiles per page with --spectate; PageUp/PageDown flip pages (default: %(default)s)")
+    parser.add_argument('--level', type=int, choices=sorted(LEVEL_DATA), default=1,
+                        help="level to start on (default: %(default)s)")
+    parser.add_argument('--level-file', metavar='PATH', default=None,
+                        help="play the level in the JSON file PATH and apply edits to it as they are saved "
+                             "(created from --level if missing; runs single-threaded)")
+    generated = parser.add_argument_group('generated level', "play a procedurally generated level instead")
+    generated.add_argument('--generate', type=int, metavar='SEED', default=None,
+                           help="generate a level from SEED and start on it")
+    generated.add_argument('--blocks', type=int, default=200,
+                           help="floating blocks to place (default: %(default)s)")
+    generated.add_argument('--density', type=float, default=0.35,
+                           help="chance of a block in each cell above the ground (default: %(default)s)")
+    generated.add_argument('--enemies', type=int, default=10,
+                           help="enemy spawns (default: %(default)s)")
+    generated.add_argument('--question-ratio', type=float, default=0.1,
+                           help="fraction of blocks that are question blocks (default: %(default)s)")
+    generated.add_argument('--pits', action='store_true',
+                           help="allow pits and low blocks; the exit may be unreachable")
+    generated.add_argument('--check-generated', type=positive_int, metavar='N', default=None,
+                           help="have the bot finish the levels generated from seeds 0..N-1 "
+                                "(or from --generate on) and exit")
+    args = parser.parse_args(argv)
+    if args.record:
+        # Only the game loops and --bot record their frames
+        for flag, given in (('--asyncio', args.use_asyncio), ('--control', args.control),
+                            ('--spectate', args.spectate)):
+            if given:
+                parser.error(f"--record cannot be combined with {flag}")
+    return args
+
+def draw_start_screen(screen):
     screen.fill(BACKGROUND_COLOR)
-    title_text = big_font.render(GAME_TITLE, True, PLAYER_RED)
+    title_text = render_text(big_font, GAME_TITLE, PLAYER_RED)
     title_rect = title_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 50))
-    screen.blit(title_text, title_rect)
+    blit_logical(screen, title_text, title_rect)
     
-    start_text = font.render("Press any key to start", True, TEXT_COLOR)
+    start_text = render_text(font, "Press any key to start", TEXT_COLOR)
     start_rect = start_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
-    screen.blit(start_text, start_rect)
-    
-    pygame.display.flip()
-    
-    waiting = True
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                waiting = False
-    
-    game_loop()
-    pygame.quit()
-    sys.exit()
+    blit_logical(screen, start_text, start_rect)
+
+def wait_for_start():
+    """Wait for a key on the start screen; False if the window was closed."""
+    while True:
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            return False
+        if event.type == pygame.KEYDOWN:
+            return True
+        if event.type == pygame.WINDOWEXPOSED:
+            present()
+
+def main(argv=None):
+    args = parse_args(argv)
+    vsync = args.pacing == 'vsync'
+    if (args.render_size != (SCREEN_WIDTH, SCREEN_HEIGHT) or args.window_size
+            or args.fullscreen or args.present != 'window' or vsync):
+        configure_display(render_size=args.render_size, window_size=args.window_size,
+                          fullscreen=args.fullscreen, backend=args.present, vsync=vsync)
+    configure_pacing(args.pacing)
+    if vsync and not display.vsync:
+        print("No vsync with this --present backend; pacing with 'spin' instead", file=sys.stderr)
+
+    if args.sim_hz != SIM_HZ:
+        configure_simulation(args.sim_hz)
+    global blit_audit
+    if args.audit_blits:
+        blit_audit = BlitAudit()
+    if args.capture or args.capture_pipe:
+        start_capture(args.capture, args.capture_pipe, args.capture_queue)
+    writer = MetricsWriter(args.metrics, args.metrics_interval) if args.metrics else None
+    try:
+        status = run(args)
+    finally:
+        if writer is not None:
+            writer.close()
+            if writer.error is not None:
+                print(f"Could not write metrics: {writer.error}", file=sys.stderr)
+        stop_capture()
+        if blit_audit is not None:
+            blit_audit.report()
+        pygame.quit()
+    sys.exit(1 if status else 0)
+
+def run(args):
+    if args.inspect_log:
+        return inspect_log(args.inspect_log, args.log_frame)
+
+    if args.render_check:
+        return render_check(args.render_check, update=args.update_golden)
+
+    if args.check_generated:
+        first = args.generate or 0
+        return check_generated(range(first, first + args.check_generated), args.bot_beam,
+                               blocks=args.blocks, density=args.density, enemies=args.enemies,
+                               question_ratio=args.question_ratio, reachable=not args.pits)
+
+    start_level = args.level
+    if args.generate is not None:
+        start_level = add_level(generate_level(args.generate, blocks=args.blocks, density=args.density,
+                                               enemies=args.enemies, question_ratio=args.question_ratio,
+                                               reachable=not args.pits))
+
+    watcher = None
+    if args.level_file:
+        if not os.path.exists(args.level_file):
+            write_level_file(args.level_file, LEVEL_DATA[start_level])
+        try:
+            with open(args.level_file) as file:
+                data = parse_level(file.read())
+        except (OSError, ValueError) as error:
+            print(f"{args.level_file}: {error}", file=sys.stderr)
+            return 1
+        start_level = add_level(data)
+        watcher = LevelWatcher(args.level_file, start_level)
+
+    # Soak and spectate cycle through the built-in levels unless given one
+    levels = None if start_level == args.level else [start_level]
+    if args.soak:
+        return soak(args.soak, frames=args.soak_frames, levels=levels)
+
+    if args.spectate:
+        return spectate(args.spectate, tiles=args.spectate_tiles, levels=levels)
+
+    session_log = None
+    if args.record:
+        session_log = SessionRecorder(args.record, {'level': start_level, 'seed': args.generate},
+                                      compression=args.record_compression)
+    try:
+        if args.bot:
+            return run_bot(start_level, args.bot_beam, watch=args.bot_watch, session_log=session_log)
+
+        if args.control:
+            serve_control(args.control, start_level=start_level)
+            return
+
+        if args.use_asyncio:
+            asyncio.run(async_main(start_level=start_level))
+            return
+
+        # Start screen
+        draw_start_screen(screen)
+        present()
+
+        if not wait_for_start():
+            return
+
+        game_loop(threaded=args.threaded and watcher is None, start_level=start_level,
+                  profile=args.profile, profile_dir=args.profile_dir, watcher=watcher,
+                  session_log=session_log)
+    finally:
+        if session_log is not None:
+            session_log.close()
 
 if __name__ == '__main__':
     main()
@@ -49,6 +49,10 @@ clock = pygame.time.Clock()
 font = pygame.font.Font(None, 24)
 big_font = pygame.font.Font(None, 48)
 
+def render_text(text_font, message, color):
+    """``message`` in the display's pixel format, so blitting it doesn't convert every pixel."""
+    return text_font.render(message, True, color).convert_alpha()
+
 # --- Particle System ---
 class Particle:
     def __init__(self, x, y, vx, vy, color, life=30):
@@ -159,7 +163,7 @@ LEVEL_DATA = {
 class Player(pygame.sprite.Sprite):
     def __init__(self):
         super().__init__()
-        self.surf = pygame.Surface((32, 40), pygame.SRCALPHA)
+        self.surf = pygame.Surface((32, 40), pygame.SRCALPHA).convert_alpha()
         self.rect = self.surf.get_rect(center=(100, SCREEN_HEIGHT - 100))
         self.pos = pygame.math.Vector2(self.rect.topleft)
         self.vel = pygame.math.Vector2(0, 0)
@@ -326,7 +330,7 @@ class Platform(pygame.sprite.Sprite):
     def __init__(self, x, y, w, h, block_type='ground'):
         super().__init__()
         self.block_type = block_type
-        self.surf = pygame.Surface((w, h))
+        self.surf = pygame.Surface((w, h)).convert()
         self.rect = self.surf.get_rect(topleft=(x, y))
         self.hit_animation = 0
         self.original_y = y
@@ -353,7 +357,7 @@ class Platform(pygame.sprite.Sprite):
                 self.surf.fill(QUESTION_BLOCK_COLOR)
                 # Animated question mark
                 q_font = pygame.font.Font(None, int(self.rect.h * 0.8))
-                q_text = q_font.render("?", True, BLACK)
+                q_text = render_text(q_font, "?", BLACK)
                 q_rect = q_text.get_rect(center=self.surf.get_rect().center)
                 self.surf.blit(q_text, q_rect)
         elif self.block_type == 'pipe':
@@ -381,7 +385,7 @@ class Platform(pygame.sprite.Sprite):
 class Enemy(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.surf = pygame.Surface((32, 32), pygame.SRCALPHA)
+        self.surf = pygame.Surface((32, 32), pygame.SRCALPHA).convert_alpha()
         self.rect = self.surf.get_rect(topleft=(x, y))
         self.pos = pygame.math.Vector2(float(x), float(y))
         self.vel = pygame.math.Vector2(ENEMY_SPEED, 0)
@@ -424,7 +428,7 @@ class Enemy(pygame.sprite.Sprite):
 
 # --- Screen Transition Effect ---
 def transition_effect(screen, direction='out'):
-    transition_surf = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+    transition_surf = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
     
     for i in range(20):
         if direction == 'out':
@@ -572,7 +576,7 @@ def game_loop():
                 exit_x, exit_y = level_data['exit_pos']
                 if (abs(player.rect.centerx - exit_x) < 40 and 
                     abs(player.rect.centery - exit_y) < 60):
-                    hint_text = font.render("Press DOWN to enter", True, TEXT_COLOR)
+                    hint_text = render_text(font, "Press DOWN to enter", TEXT_COLOR)
                     hint_rect = hint_text.get_rect(center=(exit_x, exit_y - 80))
                     screen.blit(hint_text, hint_rect)
             
@@ -580,11 +584,11 @@ def game_loop():
     
     # Game complete screen
     screen.fill(BACKGROUND_COLOR)
-    complete_text = big_font.render("GAME COMPLETE!", True, TEXT_COLOR)
+    complete_text = render_text(big_font, "GAME COMPLETE!", TEXT_COLOR)
     complete_rect = complete_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
     screen.blit(complete_text, complete_rect)
     
-    thanks_text = font.render("Thanks for playing!", True, TEXT_COLOR)
+    thanks_text = render_text(font, "Thanks for playing!", TEXT_COLOR)
     thanks_rect = thanks_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
     screen.blit(thanks_text, thanks_rect)
     
@@ -610,14 +614,14 @@ def draw_game(screen, all_sprites, particles, level):
         particle.draw(screen)
     
     # UI
-    fps_text = font.render(f"FPS: {int(clock.get_fps())}", True, TEXT_COLOR)
+    fps_text = render_text(font, f"FPS: {int(clock.get_fps())}", TEXT_COLOR)
     screen.blit(fps_text, (10, 10))
     
-    level_text = font.render(f"World 1-{level}", True, TEXT_COLOR)
+    level_text = render_text(font, f"World 1-{level}", TEXT_COLOR)
     screen.blit(level_text, (SCREEN_WIDTH - 100, 10))
     
     # Controls hint
-    controls_text = font.render("WASD/Arrows to move, SPACE/UP to jump, SHIFT/Z to run", True, TEXT_COLOR)
+    controls_text = render_text(font, "WASD/Arrows to move, SPACE/UP to jump, SHIFT/Z to run", TEXT_COLOR)
     controls_rect = controls_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT - 20))
     screen.blit(controls_text, controls_rect)
 
@@ -625,11 +629,11 @@ def draw_game(screen, all_sprites, particles, level):
 def main():
     # Start screen
     screen.fill(BACKGROUND_COLOR)
-    title_text = big_font.render(GAME_TITLE, True, PLAYER_RED)
+    title_text = render_text(big_font, GAME_TITLE, PLAYER_RED)
     title_rect = title_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 50))
     screen.blit(title_text, title_rect)
     
-    start_text = font.render("Press any key to start", True, TEXT_COLOR)
+    start_text = render_text(font, "Press any key to start", TEXT_COLOR)
     start_rect = start_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
     screen.blit(start_text, start_rect)
     
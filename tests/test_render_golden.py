@@ -0,0 +1,16 @@
+"""The golden-frame check behind ``smb0.py --render-check``, run under pytest."""
+import os
+import sys
+
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smb0  # noqa: E402
+
+
+def test_golden_frames_match(tmp_path):
+    dump_dir = tmp_path / 'golden_failures'
+    failures = smb0.render_check(dump_dir=str(dump_dir))
+    dumped = sorted(os.listdir(dump_dir)) if dump_dir.exists() else []
+    assert failures == 0, f"{failures} frames differ from {smb0.GOLDEN_FRAMES_PATH}: {dumped}"